@@ -14,17 +14,24 @@ PART 1/4
 """
 
 import os
+import gzip
 import html
+import hashlib
 import json
 import asyncio
 import sqlite3
+import shutil
 import secrets
+import time
 import threading
+import functools
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
-from calendar import monthrange
 from pathlib import Path
-from typing import Optional, Dict, List, Tuple, Any
-from urllib.parse import quote
+from contextlib import contextmanager
+from typing import Optional, Dict, List, Tuple, Any, Union
+from urllib.parse import quote, urlencode
 
 from zoneinfo import ZoneInfo
 from aiohttp import web
@@ -68,6 +75,31 @@ if not BOT_TOKEN:
 
 PORT = int(os.getenv("PORT", "10000"))
 DB_PATH = os.getenv("DB_PATH", "bot.db")
+DB_POOL_SIZE = max(1, int(os.getenv("DB_POOL_SIZE", "4")))
+# Отдельный пул read-only соединений для отчётов и админки
+DB_READ_POOL_SIZE = max(1, int(os.getenv("DB_READ_POOL_SIZE", "2")))
+DB_READ_CACHE_MB = max(1, int(os.getenv("DB_READ_CACHE_MB", "32")))
+DB_READ_MMAP_MB = max(0, int(os.getenv("DB_READ_MMAP_MB", "256")))
+# Профилировщик БД: время и строки по методам Database, лог медленных SQL с планом
+DB_PROFILE = os.getenv("DB_PROFILE", "").strip().lower() in ("1", "true", "yes", "on")
+DB_SLOW_MS = max(0.0, float(os.getenv("DB_SLOW_MS", "50")))
+EVENTS_BATCH_SIZE = max(1, int(os.getenv("EVENTS_BATCH_SIZE", "50")))
+EVENTS_FLUSH_SECONDS = max(1, int(os.getenv("EVENTS_FLUSH_SECONDS", "5")))
+# Сырые события старше N дней уезжают в архивную базу; 0 — хранить всё в основной
+EVENTS_RETENTION_DAYS = max(0, int(os.getenv("EVENTS_RETENTION_DAYS", "90")))
+EVENTS_ARCHIVE_PATH = os.getenv("EVENTS_ARCHIVE_PATH", "").strip() or str(
+    Path(DB_PATH).with_name(Path(DB_PATH).stem + "_archive.db")
+)
+USER_CACHE_SIZE = max(0, int(os.getenv("USER_CACHE_SIZE", "10000")))
+USER_CACHE_TTL = max(0, int(os.getenv("USER_CACHE_TTL", "600")))
+# Корзина без изменений дольше N дней считается брошенной и удаляется; 0 — не чистить
+CART_TTL_DAYS = max(0, int(os.getenv("CART_TTL_DAYS", "30")))
+# Сколько часов повтор POST /api/shop/order с тем же Idempotency-Key возвращает исходный заказ
+IDEMPOTENCY_TTL_HOURS = max(1, int(os.getenv("IDEMPOTENCY_TTL_HOURS", "24")))
+BACKUP_DIR = os.getenv("BACKUP_DIR", "").strip() or str(Path(DB_PATH).parent / "backups")
+BACKUP_KEEP = max(1, int(os.getenv("BACKUP_KEEP", "7")))
+# 0 — только по команде /backup или /cron/backup
+BACKUP_INTERVAL_HOURS = max(0, int(os.getenv("BACKUP_INTERVAL_HOURS", "24")))
 
 BASE_URL = os.getenv("BASE_URL", "").strip().rstrip("/")
 if not BASE_URL:
@@ -125,6 +157,75 @@ DELIVERY_TYPES = ("yandex_courier", "b2b_post", "yandex_pvz")
 PAYMENT_METHODS = ("click", "payme")
 PAYMENT_STATUSES = ("pending", "paid", "failed", "cancelled", "refunded")
 ORDER_STATUSES = ("new", "processing", "confirmed", "paid", "shipped", "delivered", "cancelled")
+REMINDER_AFTER = timedelta(minutes=30)
+# Каталог WebApp: товаров на странице по умолчанию и максимум, готовых ответов в памяти
+CATALOG_PAGE_SIZE = 24
+CATALOG_PAGE_MAX = 100
+CATALOG_CACHE_SIZE = 256
+# Больше изменений за раз дельта не отдаёт: клиент перезагружает каталог целиком
+CATALOG_DELTA_MAX = 500
+DB_PROFILE_SAMPLES = 1000
+DB_SLOW_LOG_SIZE = 50
+BACKUP_STEP_PAGES = 256
+BACKUP_STEP_SLEEP = 0.01
+STATS_STATUS_KEYS = {
+    "new": "new_count",
+    "processing": "processing",
+    "confirmed": "confirmed",
+    "paid": "paid_count",
+    "shipped": "shipped",
+    "delivered": "delivered",
+    "cancelled": "cancelled",
+}
+STATS_KEYS = ("total", *STATS_STATUS_KEYS.values(), "unique_users")
+ROLLUP_ORDER_DIMS = {
+    "status": "status",
+    "city": "city",
+    "payment": "payment_method",
+    "delivery": "delivery_type",
+}
+
+DEMO_PRODUCTS = [
+    {
+        "photo_file_id": "",
+        "title_ru": "Kids Hoodie",
+        "title_uz": "Bolalar hudi",
+        "description_ru": "Тёплый и стильный худи для повседневной носки.",
+        "description_uz": "Kundalik kiyish uchun issiq va zamonaviy hudi.",
+        "sizes": "98,104,110,116",
+        "category_slug": "new",
+        "price": 250000,
+        "old_price": 290000,
+        "price_on_request": 0,
+        "stock_qty": 15,
+    },
+    {
+        "photo_file_id": "",
+        "title_ru": "Mini Boss Suit",
+        "title_uz": "Mini Boss kostyum",
+        "description_ru": "Стильный комплект для особых дней.",
+        "description_uz": "Maxsus kunlar uchun zamonaviy to‘plam.",
+        "sizes": "104,110,116,122",
+        "category_slug": "hits",
+        "price": 390000,
+        "old_price": 0,
+        "price_on_request": 0,
+        "stock_qty": 8,
+    },
+    {
+        "photo_file_id": "",
+        "title_ru": "School Set",
+        "title_uz": "Maktab formasi",
+        "description_ru": "Школьная форма премиум качества.",
+        "description_uz": "Premium sifatdagi maktab formasi.",
+        "sizes": "110,116,122,128,134",
+        "category_slug": "school",
+        "price": 320000,
+        "old_price": 350000,
+        "price_on_request": 0,
+        "stock_qty": 20,
+    },
+]
 
 
 # =========================================================
@@ -138,6 +239,19 @@ def now_str() -> str:
     return now_tz().strftime("%Y-%m-%d %H:%M:%S")
 
 
+def to_ts(value: Optional[str]) -> Optional[int]:
+    """
+    Строка формата now_str() (локальное время TZ) -> unix epoch.
+    В *_ts колонках хранится то же время, что и в текстовых *_at.
+    """
+    if not value:
+        return None
+    try:
+        return int(datetime.strptime(value[:19], "%Y-%m-%d %H:%M:%S").replace(tzinfo=TZ).timestamp())
+    except ValueError:
+        return None
+
+
 def esc(value: Any) -> str:
     return html.escape("" if value is None else str(value))
 
@@ -176,6 +290,38 @@ def product_public_photo_url(file_id: str) -> str:
     return f"/media/{quote(file_id)}"
 
 
+def split_range_by_days(start: str, end: str) -> Tuple[Optional[Tuple[str, str]], List[Tuple[str, str]]]:
+    """
+    Делит интервал [start, end] на целые дни (читаются из rollup-таблиц)
+    и неполные края (читаются из сырых строк).
+    """
+    try:
+        start_dt = datetime.strptime(start, "%Y-%m-%d %H:%M:%S")
+        end_dt = datetime.strptime(end, "%Y-%m-%d %H:%M:%S")
+    except ValueError:
+        return None, [(start, end)]
+
+    if end_dt < start_dt:
+        return None, []
+
+    first_day = start_dt.date()
+    if start_dt.time() != datetime.min.time():
+        first_day += timedelta(days=1)
+    last_day = end_dt.date()
+    if end_dt.strftime("%H:%M:%S") != "23:59:59":
+        last_day -= timedelta(days=1)
+
+    if first_day > last_day:
+        return None, [(start, end)]
+
+    edges: List[Tuple[str, str]] = []
+    if first_day > start_dt.date():
+        edges.append((start, f"{start_dt.date()} 23:59:59"))
+    if last_day < end_dt.date():
+        edges.append((f"{end_dt.date()} 00:00:00", end))
+    return (first_day.isoformat(), last_day.isoformat()), edges
+
+
 def prev_month(dt: datetime) -> tuple[int, int]:
     first_day = dt.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
     prev_last_day = first_day - timedelta(days=1)
@@ -220,6 +366,14 @@ def normalize_phone(phone: str) -> str:
     return cleaned
 
 
+def phone_digits(phone: str) -> str:
+    return "".join(ch for ch in (phone or "") if ch.isdigit())
+
+
+def fts_phrase(text: str) -> str:
+    return '"' + text.replace('"', '""') + '"'
+
+
 def phone_is_valid(phone: str) -> bool:
     phone = normalize_phone(phone)
     digits = "".join(ch for ch in phone if ch.isdigit())
@@ -233,6 +387,22 @@ def parse_sizes_text(sizes: str) -> List[str]:
     return [x.strip() for x in raw.split(",") if x.strip()]
 
 
+def cart_to_order_items(cart: List[Dict]) -> List[Dict]:
+    items: List[Dict] = []
+    for row in cart:
+        items.append({
+            "cart_id": row.get("id"),
+            "product_id": row.get("product_id"),
+            "product_name": row.get("product_name", ""),
+            "name": row.get("product_name", ""),
+            "price": safe_int(row.get("price"), 0),
+            "qty": safe_int(row.get("qty"), 1),
+            "size": row.get("size", ""),
+            "photo_file_id": row.get("photo_file_id", ""),
+        })
+    return items
+
+
 def user_lang_or_default(user_row: Optional[Dict]) -> str:
     if user_row and user_row.get("lang") in ("ru", "uz"):
         return user_row["lang"]
@@ -379,17 +549,310 @@ def t(lang: str, key: str) -> str:
     return TEXTS.get(key, {}).get(lang, TEXTS.get(key, {}).get("ru", key))
 
 
+# =========================================================
+# DB PROFILER
+# =========================================================
+def result_rows(result: Any) -> int:
+    """Сколько строк вернул метод Database (для профилировщика)."""
+    if result is None:
+        return 0
+    if isinstance(result, dict) and isinstance(result.get("rows"), list):
+        return len(result["rows"])
+    if isinstance(result, (list, tuple)):
+        return len(result)
+    return 1
+
+
+def percentile(sorted_values: List[float], q: float) -> float:
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(q * len(sorted_values)))]
+
+
+class DbProfiler:
+    """
+    Статистика по методам Database и SQL-выражениям. Для перцентилей хранятся
+    последние DB_PROFILE_SAMPLES замеров на метод, медленные SQL (> DB_SLOW_MS) —
+    в кольцевом логе вместе с EXPLAIN QUERY PLAN.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self) -> None:
+        with self._lock:
+            self.started_at = now_str()
+            self._methods: Dict[str, Dict[str, Any]] = {}
+            self._sql: Dict[str, Dict[str, Any]] = {}
+            self._slow: deque = deque(maxlen=DB_SLOW_LOG_SIZE)
+
+    def record_call(self, name: str, seconds: float, rows: int) -> None:
+        with self._lock:
+            m = self._methods.get(name)
+            if m is None:
+                m = self._methods[name] = {
+                    "calls": 0, "total": 0.0, "rows": 0,
+                    "samples": deque(maxlen=DB_PROFILE_SAMPLES),
+                }
+            m["calls"] += 1
+            m["total"] += seconds
+            m["rows"] += rows
+            m["samples"].append(seconds)
+
+    def record_sql(self, sql: str, seconds: float, new_statement: bool) -> None:
+        key = " ".join(sql.split())[:300]
+        with self._lock:
+            q = self._sql.get(key)
+            if q is None:
+                q = self._sql[key] = {"calls": 0, "total": 0.0, "max": 0.0}
+            if new_statement:
+                q["calls"] += 1
+            q["total"] += seconds
+            q["max"] = max(q["max"], seconds)
+
+    def record_slow(self, sql: str, params: Any, seconds: float, plan: List[str]) -> None:
+        entry = {
+            "at": now_str(),
+            "ms": round(seconds * 1000, 1),
+            "sql": " ".join(sql.split())[:1000],
+            "params": repr(params)[:300],
+            "plan": plan,
+        }
+        with self._lock:
+            self._slow.append(entry)
+        print(f"🐢 Медленный SQL {entry['ms']} мс: {entry['sql'][:200]} | {' / '.join(plan)}")
+
+    def report(self, limit: int = 20) -> Dict[str, Any]:
+        with self._lock:
+            methods = []
+            for name, m in self._methods.items():
+                samples = sorted(m["samples"])
+                methods.append({
+                    "method": name,
+                    "calls": m["calls"],
+                    "total_ms": round(m["total"] * 1000, 1),
+                    "avg_ms": round(m["total"] / m["calls"] * 1000, 2),
+                    "p50_ms": round(percentile(samples, 0.50) * 1000, 2),
+                    "p95_ms": round(percentile(samples, 0.95) * 1000, 2),
+                    "p99_ms": round(percentile(samples, 0.99) * 1000, 2),
+                    "rows": m["rows"],
+                    "avg_rows": round(m["rows"] / m["calls"], 1),
+                })
+            statements = [
+                {
+                    "sql": key,
+                    "calls": q["calls"],
+                    "total_ms": round(q["total"] * 1000, 1),
+                    "max_ms": round(q["max"] * 1000, 1),
+                }
+                for key, q in self._sql.items()
+            ]
+            slow = list(self._slow)
+
+        methods.sort(key=lambda x: x["total_ms"], reverse=True)
+        statements.sort(key=lambda x: x["total_ms"], reverse=True)
+        return {
+            "enabled": DB_PROFILE,
+            "since": self.started_at,
+            "slow_ms": DB_SLOW_MS,
+            "methods": methods[:limit],
+            "sql": statements[:limit],
+            "slow": slow[::-1],
+        }
+
+
+db_profiler = DbProfiler()
+
+
+class ProfilingCursor(sqlite3.Cursor):
+    """
+    Курсор, который замеряет execute и fetch*: у SELECT основная работа часто
+    приходится на выборку строк, поэтому время копится до конца чтения.
+    """
+
+    _prof_sql: Optional[str] = None
+    _prof_params: Any = None
+    _prof_elapsed = 0.0
+    _prof_logged = False
+
+    def _prof_track(self, seconds: float, sql: Optional[str] = None, params: Any = None) -> None:
+        new_statement = sql is not None
+        if new_statement:
+            self._prof_sql, self._prof_params = sql, params
+            self._prof_elapsed, self._prof_logged = 0.0, False
+        if self._prof_sql is None:
+            return
+        self._prof_elapsed += seconds
+        db_profiler.record_sql(self._prof_sql, seconds, new_statement)
+        # В лог медленных идут только запросы с планом: PRAGMA/BEGIN/COMMIT
+        # видны в статистике методов
+        if not self._prof_logged and self._prof_elapsed * 1000 >= DB_SLOW_MS and sql_has_plan(self._prof_sql):
+            self._prof_logged = True
+            db_profiler.record_slow(
+                self._prof_sql,
+                self._prof_params,
+                self._prof_elapsed,
+                explain_query_plan(self.connection, self._prof_sql, self._prof_params),
+            )
+
+    def execute(self, sql, parameters=()):
+        started = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            self._prof_track(time.perf_counter() - started, sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        seq_of_parameters = list(seq_of_parameters)
+        started = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            first = seq_of_parameters[0] if seq_of_parameters else ()
+            self._prof_track(time.perf_counter() - started, sql, first)
+
+    def fetchone(self):
+        started = time.perf_counter()
+        try:
+            return super().fetchone()
+        finally:
+            self._prof_track(time.perf_counter() - started)
+
+    def fetchmany(self, *args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return super().fetchmany(*args, **kwargs)
+        finally:
+            self._prof_track(time.perf_counter() - started)
+
+    def fetchall(self):
+        started = time.perf_counter()
+        try:
+            return super().fetchall()
+        finally:
+            self._prof_track(time.perf_counter() - started)
+
+
+class ProfilingConnection(sqlite3.Connection):
+    # Connection.execute() создаёт базовый курсор в обход cursor(), поэтому
+    # переопределены все три точки входа
+    def cursor(self, factory=ProfilingCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+
+def sql_has_plan(sql: str) -> bool:
+    words = sql.split(None, 1)
+    return bool(words) and words[0].upper() in ("SELECT", "WITH", "INSERT", "UPDATE", "DELETE", "REPLACE")
+
+
+def explain_query_plan(conn: sqlite3.Connection, sql: str, params: Any) -> List[str]:
+    try:
+        # Базовый курсор: план не должен попадать в статистику профилировщика
+        cur = sqlite3.Connection.cursor(conn, sqlite3.Cursor)
+        return [row[3] for row in cur.execute("EXPLAIN QUERY PLAN " + sql, params or ()).fetchall()]
+    except Exception as e:
+        return [f"plan error: {e}"]
+
+
+def profile_methods(cls):
+    """Оборачивает публичные методы класса замером времени и числа строк."""
+    for name, method in list(vars(cls).items()):
+        if name.startswith("_") or not callable(method):
+            continue
+
+        def make_wrapper(name: str, method):
+            @functools.wraps(method)
+            def wrapper(self, *args, **kwargs):
+                started = time.perf_counter()
+                result = None
+                try:
+                    result = method(self, *args, **kwargs)
+                    return result
+                finally:
+                    db_profiler.record_call(name, time.perf_counter() - started, result_rows(result))
+            return wrapper
+
+        setattr(cls, name, make_wrapper(name, method))
+    return cls
+
+
 # =========================================================
 # DATABASE
 # =========================================================
+class LruTtlCache:
+    """
+    Потокобезопасный LRU-кеш с TTL: не больше maxsize записей,
+    каждая живёт ttl секунд. maxsize=0 или ttl=0 — кеш выключен.
+    """
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: "OrderedDict[Any, Tuple[float, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Any) -> Any:
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return None
+            expires_at, value = item
+            if expires_at < time.monotonic():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key: Any, value: Any) -> None:
+        if self.maxsize <= 0 or self.ttl <= 0:
+            return
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key: Any) -> None:
+        with self._lock:
+            self._data.pop(key, None)
+
+
+def db_read(method):
+    """
+    Помечает метод Database как чтение для отчётов/админки: AsyncDatabase
+    выполняет его в отдельном пуле, а сам метод берёт _get_read_conn().
+    """
+    method._db_read = True
+    return method
+
+
 class Database:
     def __init__(self, db_path: str):
         self.db_path = db_path
         self._local = threading.local()
+        self._events_buffer: List[Tuple[Optional[int], str, str, str]] = []
+        self._events_lock = threading.Lock()
+        self.fts_enabled = False
+        # Зеркало catalog_state.version: веб-кеш каталога сверяется с ним без запроса в БД
+        self.catalog_version = 0
+        # Профили пользователей: get_user_lang и ensure_user_record дёргают их на каждое нажатие
+        self._users = LruTtlCache(USER_CACHE_SIZE, USER_CACHE_TTL)
         self._init_db()
 
     def _connect(self) -> sqlite3.Connection:
-        conn = sqlite3.connect(self.db_path, check_same_thread=False, timeout=20)
+        conn = sqlite3.connect(
+            self.db_path,
+            check_same_thread=False,
+            timeout=20,
+            factory=ProfilingConnection if DB_PROFILE else sqlite3.Connection,
+        )
         conn.row_factory = sqlite3.Row
         try:
             conn.execute("PRAGMA journal_mode=WAL;")
@@ -405,11 +868,144 @@ class Database:
             self._local.conn = self._connect()
         return self._local.conn
 
-    def _init_db(self) -> None:
+    def _connect_read(self) -> sqlite3.Connection:
         conn = self._connect()
+        try:
+            conn.execute("PRAGMA query_only=ON;")
+            conn.execute(f"PRAGMA cache_size=-{DB_READ_CACHE_MB * 1024};")
+            conn.execute(f"PRAGMA mmap_size={DB_READ_MMAP_MB * 1024 * 1024};")
+        except Exception:
+            pass
+        return conn
+
+    def _get_read_conn(self) -> sqlite3.Connection:
+        """
+        Соединение только для чтения (query_only) с собственным кешем и mmap.
+        В WAL длинное чтение не блокирует запись. Записи внутри @db_read-метода
+        (например events_flush) по-прежнему идут через _get_conn().
+        """
+        if getattr(self._local, "read_conn", None) is None:
+            self._local.read_conn = self._connect_read()
+        return self._local.read_conn
+
+    @contextmanager
+    def _transaction(self, conn: sqlite3.Connection):
         cur = conn.cursor()
+        cur.execute("BEGIN IMMEDIATE")
+        try:
+            yield cur
+        except Exception:
+            conn.rollback()
+            raise
+        conn.commit()
 
-        cur.executescript("""
+    def close(self) -> None:
+        self.events_flush()
+        for attr in ("conn", "read_conn"):
+            conn = getattr(self._local, attr, None)
+            if conn is not None:
+                conn.close()
+                setattr(self._local, attr, None)
+
+    def _init_db(self) -> None:
+        """
+        При старте — один запрос: версия схемы (PRAGMA user_version), наличие
+        orders_fts и версия каталога. Миграции запускаются, только если версия
+        отстаёт.
+        """
+        conn = self._connect()
+        try:
+            try:
+                version, fts, catalog_version = self._schema_state(conn)
+            except sqlite3.OperationalError:
+                # Схема старше миграции 11: catalog_state ещё нет
+                version, fts, catalog_version = self._schema_state(conn, with_catalog=False)
+            if version < len(self._migrations()):
+                self._run_migrations(conn, version)
+                version, fts, catalog_version = self._schema_state(conn)
+            self.fts_enabled = fts
+            self.catalog_version = catalog_version
+        finally:
+            conn.close()
+
+    def _schema_state(self, conn: sqlite3.Connection, with_catalog: bool = True) -> Tuple[int, bool, int]:
+        catalog = "(SELECT version FROM catalog_state WHERE id=1)" if with_catalog else "0"
+        row = conn.execute(f"""
+            SELECT
+                (SELECT user_version FROM pragma_user_version) AS version,
+                EXISTS(SELECT 1 FROM sqlite_master WHERE type='table' AND name='orders_fts') AS fts,
+                {catalog} AS catalog_version
+        """).fetchone()
+        return safe_int(row["version"]), bool(row["fts"]), safe_int(row["catalog_version"])
+
+    # -------------------------
+    # Migrations
+    # -------------------------
+    def _migrations(self) -> List[Tuple[str, Any]]:
+        """
+        Список миграций по порядку: номер версии = позиция в списке + 1.
+        Новые миграции только дописываются в конец, старые не меняются.
+        """
+        return [
+            ("baseline schema", self._m_baseline),
+            ("orders/products columns", self._m_legacy_columns),
+            ("order_items", self._m_order_items),
+            ("order counters", self._m_order_counters),
+            ("daily rollups", self._m_rollups),
+            ("orders_fts", self._m_orders_fts),
+            ("unseen orders index", self._m_unseen_orders_index),
+            ("demo catalog", self._m_seed_demo),
+            ("epoch timestamps", self._m_epoch_timestamps),
+            ("carts unique key", self._m_carts_unique),
+            ("catalog version", self._m_catalog_version),
+            ("catalog changes", self._m_catalog_changes),
+            ("order idempotency keys", self._m_order_idempotency),
+            ("carts added_at index", self._m_carts_added_at),
+            ("catalog page indexes", self._m_catalog_page_indexes),
+            ("idempotency request hash", self._m_idempotency_request_hash),
+        ]
+
+    def _run_migrations(self, conn: sqlite3.Connection, version: int) -> None:
+        """
+        Каждая миграция — отдельная транзакция вместе с PRAGMA user_version,
+        так что упавшая миграция не оставляет схему наполовину обновлённой.
+        """
+        if version == 0 and not conn.execute("SELECT 1 FROM sqlite_master LIMIT 1").fetchone():
+            # Новая база: VACUUM пустого файла мгновенный. Базы с данными
+            # переводятся на incremental vacuum в db_compact
+            conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+            conn.execute("VACUUM")
+
+        for number, (name, migrate) in enumerate(self._migrations(), start=1):
+            if number <= version:
+                continue
+            started = time.perf_counter()
+            with self._transaction(conn) as cur:
+                # Другой процесс мог успеть выполнить миграцию, пока мы ждали блокировку
+                current = safe_int(cur.execute("PRAGMA user_version").fetchone()[0])
+                if current >= number:
+                    continue
+                migrate(cur)
+                cur.execute(f"PRAGMA user_version = {number}")
+            elapsed = (time.perf_counter() - started) * 1000
+            print(f"🗄 Миграция {number} ({name}): {elapsed:.0f} мс")
+
+    @staticmethod
+    def _execute_script(cur: sqlite3.Cursor, script: str) -> None:
+        """
+        executescript() сам делает COMMIT, поэтому внутри транзакции миграции
+        скрипт выполняется по одному выражению.
+        """
+        statement = ""
+        for part in script.split(";"):
+            statement += part + ";"
+            if sqlite3.complete_statement(statement):
+                if statement.strip(" \t\r\n;"):
+                    cur.execute(statement)
+                statement = ""
+
+    def _m_baseline(self, cur: sqlite3.Cursor) -> None:
+        self._execute_script(cur, """
         CREATE TABLE IF NOT EXISTS users (
             user_id INTEGER PRIMARY KEY,
             username TEXT,
@@ -523,13 +1119,13 @@ class Database:
         CREATE INDEX IF NOT EXISTS idx_products_pub_cat ON shop_products(is_published, category_slug, sort_order, id);
         """)
 
-        conn.commit()
-        self._migrate_orders(conn)
-        self._migrate_products(conn)
-        conn.close()
+    def _m_legacy_columns(self, cur: sqlite3.Cursor) -> None:
+        """Колонки, которых нет в базах, созданных до версионирования."""
+        self._migrate_orders(cur)
+        self._migrate_products(cur)
 
-    def _migrate_orders(self, conn: sqlite3.Connection) -> None:
-        existing = {r["name"] for r in conn.execute("PRAGMA table_info(orders)").fetchall()}
+    def _migrate_orders(self, cur: sqlite3.Cursor) -> None:
+        existing = {r["name"] for r in cur.execute("PRAGMA table_info(orders)").fetchall()}
         columns_to_add = {
             "customer_name": "TEXT DEFAULT ''",
             "customer_phone": "TEXT DEFAULT ''",
@@ -547,67 +1143,590 @@ class Database:
             "updated_at": "TEXT",
             "source": "TEXT DEFAULT 'bot'",
         }
-        for col, sql_type in columns_to_add.items():
-            if col not in existing:
-                conn.execute(f"ALTER TABLE orders ADD COLUMN {col} {sql_type}")
-        conn.commit()
+        self._add_columns(cur, "orders", columns_to_add, existing)
 
-    def _migrate_products(self, conn: sqlite3.Connection) -> None:
-        existing = {r["name"] for r in conn.execute("PRAGMA table_info(shop_products)").fetchall()}
+    def _migrate_products(self, cur: sqlite3.Cursor) -> None:
+        existing = {r["name"] for r in cur.execute("PRAGMA table_info(shop_products)").fetchall()}
         columns_to_add = {
             "old_price": "INTEGER DEFAULT 0",
             "stock_qty": "INTEGER DEFAULT 0",
         }
-        for col, sql_type in columns_to_add.items():
+        self._add_columns(cur, "shop_products", columns_to_add, existing)
+
+    def _add_columns(
+        self,
+        cur: sqlite3.Cursor,
+        table: str,
+        columns: Dict[str, str],
+        existing: Optional[set] = None,
+    ) -> None:
+        if existing is None:
+            existing = {r["name"] for r in cur.execute(f"PRAGMA table_info({table})").fetchall()}
+        for col, sql_type in columns.items():
             if col not in existing:
-                conn.execute(f"ALTER TABLE shop_products ADD COLUMN {col} {sql_type}")
-        conn.commit()
+                cur.execute(f"ALTER TABLE {table} ADD COLUMN {col} {sql_type}")
+
+    def _m_order_items(self, cur: sqlite3.Cursor, batch_size: int = 500) -> None:
+        """
+        Таблица order_items и перенос в неё строк из JSON orders.items.
+        Заказы читаются пачками по id, чтобы не держать всё в памяти.
+        """
+        self._execute_script(cur, """
+        CREATE TABLE IF NOT EXISTS order_items (
+            order_id INTEGER NOT NULL,
+            line_no INTEGER NOT NULL,
+            product_id INTEGER,
+            product_name TEXT DEFAULT '',
+            size TEXT DEFAULT '',
+            price INTEGER DEFAULT 0,
+            qty INTEGER DEFAULT 1,
+            created_at TEXT,
+            PRIMARY KEY (order_id, line_no)
+        );
+
+        CREATE INDEX IF NOT EXISTS idx_order_items_product ON order_items(product_id);
+        CREATE INDEX IF NOT EXISTS idx_order_items_created ON order_items(created_at);
+        """)
+
+        last_id = 0
+        while True:
+            rows = cur.execute("""
+                SELECT id, items, created_at FROM orders
+                WHERE id > ?
+                ORDER BY id ASC
+                LIMIT ?
+            """, (last_id, batch_size)).fetchall()
+            if not rows:
+                break
+
+            # Вставка зафиксирована на схеме этой миграции, а не через _order_items_insert:
+            # живой хелпер пишет колонки из более поздних миграций (created_ts)
+            lines = []
+            for row in rows:
+                try:
+                    items = json.loads(row["items"] or "[]")
+                except Exception:
+                    items = []
+                for line_no, item in enumerate(items, start=1):
+                    if not isinstance(item, dict):
+                        continue
+                    lines.append((
+                        row["id"],
+                        line_no,
+                        safe_int(item.get("product_id"), 0) or None,
+                        (item.get("product_name") or item.get("name") or "").strip(),
+                        item.get("size") or "",
+                        safe_int(item.get("price"), 0),
+                        safe_int(item.get("qty"), 1),
+                        row["created_at"],
+                    ))
+            cur.executemany("""
+                INSERT OR IGNORE INTO order_items (order_id, line_no, product_id, product_name, size, price, qty, created_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            """, lines)
+            last_id = rows[-1]["id"]
+
+    def _m_order_counters(self, cur: sqlite3.Cursor) -> None:
+        self._execute_script(cur, """
+        CREATE TABLE IF NOT EXISTS order_counters (
+            name TEXT PRIMARY KEY,
+            value INTEGER NOT NULL DEFAULT 0
+        );
+
+        CREATE TABLE IF NOT EXISTS order_customers (
+            user_id INTEGER PRIMARY KEY
+        );
+        """)
+        self._stats_counters_rebuild(cur)
+
+    def _m_rollups(self, cur: sqlite3.Cursor) -> None:
+        self._execute_script(cur, """
+        CREATE TABLE IF NOT EXISTS rollup_orders_daily (
+            day TEXT NOT NULL,
+            dim TEXT NOT NULL,
+            value TEXT NOT NULL,
+            orders INTEGER NOT NULL DEFAULT 0,
+            amount INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (day, dim, value)
+        );
+
+        CREATE TABLE IF NOT EXISTS rollup_events_daily (
+            day TEXT NOT NULL,
+            event_type TEXT NOT NULL,
+            cnt INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (day, event_type)
+        );
+        """)
+        self._rollups_rebuild(cur)
+
+    def _m_orders_fts(self, cur: sqlite3.Cursor, batch_size: int = 1000) -> None:
+        """
+        FTS5-индекс (trigram) для поиска заказов по подстроке телефона, имени,
+        города, адреса и комментария. rowid = orders.id. Если sqlite собран
+        без FTS5/trigram, таблица не создаётся и поиск остаётся на LIKE.
+        """
+        try:
+            cur.execute("""
+                CREATE VIRTUAL TABLE IF NOT EXISTS orders_fts USING fts5(
+                    phone_digits, customer_name, city, address, comment,
+                    tokenize='trigram'
+                )
+            """)
+        except sqlite3.OperationalError as e:
+            print(f"⚠️ FTS5 недоступен, поиск заказов через LIKE: {e}")
+            return
+
+        self.fts_enabled = True
+        last_id = 0
+        while True:
+            rows = cur.execute("""
+                SELECT * FROM orders
+                WHERE id > ?
+                ORDER BY id ASC
+                LIMIT ?
+            """, (last_id, batch_size)).fetchall()
+            if not rows:
+                break
+            for row in rows:
+                self._orders_fts_index(cur, row["id"], dict(row))
+            last_id = rows[-1]["id"]
+
+    def _m_unseen_orders_index(self, cur: sqlite3.Cursor) -> None:
+        cur.execute("""
+            CREATE INDEX IF NOT EXISTS idx_orders_unseen_new ON orders(created_at, reminded_at)
+                WHERE status='new' AND manager_seen=0
+        """)
+
+    def _m_seed_demo(self, cur: sqlite3.Cursor) -> None:
+        """Демо-каталог для новой базы; если товары уже есть, ничего не делает."""
+        if cur.execute("SELECT 1 FROM shop_products LIMIT 1").fetchone():
+            return
+        ts = now_str()
+        cur.executemany("""
+            INSERT INTO shop_products (
+                photo_file_id, title_ru, title_uz,
+                description_ru, description_uz,
+                sizes, category_slug,
+                price, old_price, price_on_request, stock_qty,
+                is_published, sort_order,
+                created_at, updated_at
+            )
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, 1, 0, ?, ?)
+        """, [
+            (
+                p["photo_file_id"], p["title_ru"], p["title_uz"],
+                p["description_ru"], p["description_uz"],
+                p["sizes"], p["category_slug"],
+                p["price"], p["old_price"], p["price_on_request"], p["stock_qty"],
+                ts, ts,
+            )
+            for p in DEMO_PRODUCTS
+        ])
+
+    def _m_epoch_timestamps(self, cur: sqlite3.Cursor) -> None:
+        """
+        Целочисленные *_ts рядом с текстовыми *_at: диапазонные запросы и индексы
+        работают по epoch, строки для показа не меняются.
+        """
+        self._add_columns(cur, "orders", {
+            "created_ts": "INTEGER",
+            "updated_ts": "INTEGER",
+            "reminded_ts": "INTEGER",
+        })
+        self._add_columns(cur, "events", {"created_ts": "INTEGER"})
+        self._add_columns(cur, "order_items", {"created_ts": "INTEGER"})
+
+        cur.connection.create_function("local_ts", 1, to_ts, deterministic=True)
+        self._execute_script(cur, """
+        UPDATE orders SET
+            created_ts=local_ts(created_at),
+            updated_ts=local_ts(updated_at),
+            reminded_ts=local_ts(reminded_at);
+        UPDATE events SET created_ts=local_ts(created_at);
+        UPDATE order_items SET created_ts=local_ts(created_at) WHERE created_ts IS NULL;
+
+        DROP INDEX IF EXISTS idx_orders_created_at;
+        DROP INDEX IF EXISTS idx_orders_unseen_new;
+        DROP INDEX IF EXISTS idx_events_type_time;
+        DROP INDEX IF EXISTS idx_order_items_created;
+
+        CREATE INDEX IF NOT EXISTS idx_orders_created_ts ON orders(created_ts);
+        CREATE INDEX IF NOT EXISTS idx_orders_unseen_new ON orders(created_ts, reminded_ts)
+            WHERE status='new' AND manager_seen=0;
+        CREATE INDEX IF NOT EXISTS idx_events_type_ts ON events(event_type, created_ts);
+        CREATE INDEX IF NOT EXISTS idx_order_items_created_ts ON order_items(created_ts);
+        """)
+
+    def _m_carts_unique(self, cur: sqlite3.Cursor) -> None:
+        """
+        Дубли (user_id, product_id, size) схлопываются в самую раннюю строку
+        с суммой qty (NULL считается за 1, как в cart_totals), дальше cart_add
+        делает upsert по уникальному ключу.
+        Его префикс user_id заменяет idx_carts_user.
+        """
+        self._execute_script(cur, """
+        UPDATE carts SET size='' WHERE size IS NULL;
+
+        UPDATE carts SET qty=(
+            SELECT SUM(COALESCE(c2.qty, 1)) FROM carts c2
+            WHERE c2.user_id=carts.user_id AND c2.product_id=carts.product_id AND c2.size=carts.size
+        )
+        WHERE id IN (
+            SELECT MIN(id) FROM carts
+            WHERE product_id IS NOT NULL
+            GROUP BY user_id, product_id, size
+            HAVING COUNT(*) > 1
+        );
+
+        DELETE FROM carts
+        WHERE product_id IS NOT NULL
+          AND id NOT IN (
+              SELECT MIN(id) FROM carts
+              WHERE product_id IS NOT NULL
+              GROUP BY user_id, product_id, size
+          );
+
+        DROP INDEX IF EXISTS idx_carts_user;
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_carts_user_product_size ON carts(user_id, product_id, size);
+        """)
+
+    def _m_catalog_version(self, cur: sqlite3.Cursor) -> None:
+        """Версия каталога: растёт при любом изменении shop_products (см. _catalog_bump)."""
+        self._execute_script(cur, """
+        CREATE TABLE IF NOT EXISTS catalog_state (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            version INTEGER NOT NULL DEFAULT 0
+        );
+        INSERT OR IGNORE INTO catalog_state (id, version) VALUES (1, 1);
+        """)
+
+    def _m_catalog_changes(self, cur: sqlite3.Cursor) -> None:
+        """
+        Для дельта-синхронизации витрины: у товара версия последнего изменения,
+        удалённые товары остаются надгробиями с версией удаления.
+        """
+        self._add_columns(cur, "shop_products", {"version": "INTEGER NOT NULL DEFAULT 0"})
+        self._execute_script(cur, """
+        UPDATE shop_products SET version=(SELECT version FROM catalog_state WHERE id=1);
+        CREATE INDEX IF NOT EXISTS idx_products_version ON shop_products(version);
+
+        CREATE TABLE IF NOT EXISTS shop_products_deleted (
+            id INTEGER PRIMARY KEY,
+            version INTEGER NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_products_deleted_version ON shop_products_deleted(version);
+        """)
+
+    def _m_order_idempotency(self, cur: sqlite3.Cursor) -> None:
+        """Ключи Idempotency-Key веб-заказов: повтор запроса возвращает уже созданный заказ."""
+        self._execute_script(cur, """
+        CREATE TABLE IF NOT EXISTS order_idempotency (
+            key TEXT PRIMARY KEY,
+            order_id INTEGER NOT NULL,
+            created_ts INTEGER NOT NULL
+        ) WITHOUT ROWID;
+        CREATE INDEX IF NOT EXISTS idx_order_idempotency_ts ON order_idempotency(created_ts);
+        """)
+
+    def _m_carts_added_at(self, cur: sqlite3.Cursor) -> None:
+        """Индекс для carts_expire: кандидаты ищутся по диапазону added_at, без полного скана carts."""
+        self._execute_script(cur, """
+        CREATE INDEX IF NOT EXISTS idx_carts_added_at ON carts(added_at);
+        """)
+
+    def _m_catalog_page_indexes(self, cur: sqlite3.Cursor) -> None:
+        """
+        Индексы в порядке витрины (sort_order по возрастанию, id по убыванию) для
+        shop_products_page: страница читается из индекса без сортировки.
+        Категорийный индекс заменяет idx_products_pub_cat с id по возрастанию.
+        """
+        self._execute_script(cur, """
+        CREATE INDEX IF NOT EXISTS idx_products_pub_order ON shop_products(is_published, sort_order, id DESC);
+        CREATE INDEX IF NOT EXISTS idx_products_pub_cat_order
+            ON shop_products(is_published, category_slug, sort_order, id DESC);
+        DROP INDEX IF EXISTS idx_products_pub_cat;
+        """)
+
+    def _m_idempotency_request_hash(self, cur: sqlite3.Cursor) -> None:
+        """Хеш тела запроса рядом с Idempotency-Key: тот же ключ с другим заказом — конфликт."""
+        self._add_columns(cur, "order_idempotency", {"request_hash": "TEXT NOT NULL DEFAULT ''"})
+
+    def _orders_fts_index(self, cur: Union[sqlite3.Cursor, sqlite3.Connection], order_id: int, data: Dict[str, Any]) -> None:
+        if not self.fts_enabled:
+            return
+        cur.execute("""
+            INSERT OR REPLACE INTO orders_fts (rowid, phone_digits, customer_name, city, address, comment)
+            VALUES (?, ?, ?, ?, ?, ?)
+        """, (
+            order_id,
+            phone_digits(data.get("customer_phone") or ""),
+            data.get("customer_name") or "",
+            data.get("city") or "",
+            data.get("delivery_address") or data.get("pvz_address") or "",
+            data.get("comment") or "",
+        ))
 
     # -------------------------
     # Users
     # -------------------------
     def user_upsert(self, user_id: int, username: str = "", full_name: str = "", lang: str = "ru") -> None:
+        """Пишет в базу, только если username, full_name или lang действительно изменились."""
+        current = self.user_get(user_id)
+        if current and (current.get("username"), current.get("full_name"), current.get("lang")) == (
+            username, full_name, lang
+        ):
+            return
+
+        updated = now_str()
         conn = self._get_conn()
-        cur = conn.cursor()
-        cur.execute("SELECT 1 FROM users WHERE user_id=?", (user_id,))
-        if cur.fetchone():
-            cur.execute("""
+        if current:
+            conn.execute("""
                 UPDATE users
                 SET username=?, full_name=?, lang=?, updated_at=?
                 WHERE user_id=?
-            """, (username, full_name, lang, now_str(), user_id))
+            """, (username, full_name, lang, updated, user_id))
+            profile = {**current, "username": username, "full_name": full_name, "lang": lang, "updated_at": updated}
         else:
-            cur.execute("""
+            conn.execute("""
                 INSERT INTO users (user_id, username, full_name, lang, created_at, updated_at)
                 VALUES (?, ?, ?, ?, ?, ?)
-            """, (user_id, username, full_name, lang, now_str(), now_str()))
+                ON CONFLICT(user_id) DO UPDATE SET
+                    username=excluded.username,
+                    full_name=excluded.full_name,
+                    lang=excluded.lang,
+                    updated_at=excluded.updated_at
+            """, (user_id, username, full_name, lang, updated, updated))
+            profile = None
         conn.commit()
 
+        if profile:
+            self._users.set(user_id, profile)
+        else:
+            self._users.pop(user_id)
+
     def user_get(self, user_id: int) -> Optional[Dict]:
+        cached = self._users.get(user_id)
+        if cached is not None:
+            return dict(cached)
+
         conn = self._get_conn()
         row = conn.execute("SELECT * FROM users WHERE user_id=?", (user_id,)).fetchone()
-        return dict(row) if row else None
+        if not row:
+            return None
+        profile = dict(row)
+        self._users.set(user_id, profile)
+        return dict(profile)
 
     def user_set_lang(self, user_id: int, lang: str) -> None:
         conn = self._get_conn()
         conn.execute("UPDATE users SET lang=?, updated_at=? WHERE user_id=?", (lang, now_str(), user_id))
         conn.commit()
+        self._users.pop(user_id)
 
     # -------------------------
     # Events
     # -------------------------
     def event_add(self, user_id: Optional[int], event_type: str, meta: Optional[Dict] = None) -> None:
-        conn = self._get_conn()
-        conn.execute("""
-            INSERT INTO events (user_id, event_type, meta, created_at)
-            VALUES (?, ?, ?, ?)
-        """, (
+        """
+        События пишутся не сразу, а через буфер: пачка сбрасывается одной
+        транзакцией при EVENTS_BATCH_SIZE строк или по таймеру events_flush_loop.
+        """
+        row = (
             user_id,
             event_type,
             json.dumps(meta or {}, ensure_ascii=False),
             now_str(),
-        ))
+        )
+        with self._events_lock:
+            self._events_buffer.append(row)
+            full = len(self._events_buffer) >= EVENTS_BATCH_SIZE
+        if full:
+            # Основная запись вызывающего уже сохранена: ошибка сброса не должна
+            # до него дойти. Строки вернулись в буфер, events_flush_loop повторит
+            try:
+                self.events_flush()
+            except Exception as e:
+                print("event_add flush error:", e)
+
+    def events_flush(self) -> int:
+        with self._events_lock:
+            rows, self._events_buffer = self._events_buffer, []
+        if not rows:
+            return 0
+
+        conn = self._get_conn()
+        try:
+            with self._transaction(conn) as cur:
+                self._events_insert(cur, rows)
+        except Exception:
+            with self._events_lock:
+                self._events_buffer[:0] = rows
+            raise
+        return len(rows)
+
+    def _events_insert(self, cur: sqlite3.Cursor, rows: List[Tuple[Optional[int], str, str, str]]) -> None:
+        cur.executemany("""
+            INSERT INTO events (user_id, event_type, meta, created_at, created_ts)
+            VALUES (?, ?, ?, ?, ?)
+        """, [(*row, to_ts(row[3])) for row in rows])
+
+        per_day: Dict[Tuple[str, str], int] = {}
+        for _, event_type, _, created_at in rows:
+            key = ((created_at or "")[:10], event_type or "")
+            per_day[key] = per_day.get(key, 0) + 1
+        cur.executemany("""
+            INSERT INTO rollup_events_daily (day, event_type, cnt) VALUES (?, ?, ?)
+            ON CONFLICT(day, event_type) DO UPDATE SET cnt=cnt + excluded.cnt
+        """, [(day, event_type, cnt) for (day, event_type), cnt in per_day.items()])
+
+    def events_archive(self, older_than_days: int, batch_size: int = 5000) -> int:
+        """
+        Переносит события старше older_than_days (целыми днями) в архивную базу
+        EVENTS_ARCHIVE_PATH пачками по batch_size. Дневные агрегаты остаются
+        в rollup_events_daily, так что отчёты за эти дни не меняются.
+        Возвращает число перенесённых строк.
+        """
+        self.events_flush()
+        cutoff = to_ts((now_tz() - timedelta(days=older_than_days)).strftime("%Y-%m-%d 00:00:00"))
+        conn = self._get_conn()
+        conn.execute("ATTACH DATABASE ? AS archive", (EVENTS_ARCHIVE_PATH,))
+        moved = 0
+        try:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS archive.events (
+                    id INTEGER PRIMARY KEY,
+                    user_id INTEGER,
+                    event_type TEXT,
+                    meta TEXT,
+                    created_at TEXT
+                )
+            """)
+            conn.commit()
+
+            while True:
+                with self._transaction(conn) as cur:
+                    # События пишутся по времени, поэтому самые старые — в начале rowid:
+                    # читаем голову таблицы, а не сканируем её по created_ts
+                    rows = cur.execute(
+                        "SELECT id, created_ts FROM events ORDER BY id LIMIT ?",
+                        (batch_size,),
+                    ).fetchall()
+                    last_id = None
+                    for r in rows:
+                        if (r["created_ts"] or 0) >= cutoff:
+                            break
+                        last_id = r["id"]
+                    if last_id is None:
+                        break
+
+                    # В WAL-режиме транзакция атомарна для каждой базы по отдельности:
+                    # OR IGNORE делает повтор пачки после сбоя безопасным
+                    cur.execute("""
+                        INSERT OR IGNORE INTO archive.events (id, user_id, event_type, meta, created_at)
+                        SELECT id, user_id, event_type, meta, created_at
+                        FROM events
+                        WHERE id <= ?
+                    """, (last_id,))
+                    cur.execute("DELETE FROM events WHERE id <= ?", (last_id,))
+                    moved += cur.rowcount
+        finally:
+            conn.execute("DETACH DATABASE archive")
+        return moved
+
+    def db_compact(self) -> int:
+        """
+        Возвращает файлу свободные страницы (incremental vacuum) и усекает WAL.
+        Базу без auto_vacuum=INCREMENTAL не трогает: перевод — полный VACUUM,
+        он только вручную через db_vacuum_convert. Возвращает число освобождённых страниц.
+        """
+        conn = self._get_conn()
+        if safe_int(conn.execute("PRAGMA auto_vacuum").fetchone()[0]) != 2:
+            conn.execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchall()
+            return 0
+
+        free_before = safe_int(conn.execute("PRAGMA freelist_count").fetchone()[0])
+        conn.execute("PRAGMA incremental_vacuum").fetchall()
         conn.commit()
+        free_after = safe_int(conn.execute("PRAGMA freelist_count").fetchone()[0])
+        conn.execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchall()
+        return free_before - free_after
+
+    def db_vacuum_convert(self) -> bool:
+        """
+        Однократно переводит базу на auto_vacuum=INCREMENTAL полным VACUUM.
+        VACUUM переписывает весь файл и всё это время держит блокировку записи,
+        поэтому запускается только вручную (/vacuum_convert) в тихое время.
+        Возвращает False, если база уже переведена.
+        """
+        conn = self._get_conn()
+        if safe_int(conn.execute("PRAGMA auto_vacuum").fetchone()[0]) == 2:
+            return False
+        conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        conn.execute("VACUUM")
+        return True
+
+    def events_retention(self, older_than_days: int) -> Dict[str, int]:
+        archived = self.events_archive(older_than_days)
+        freed_pages = self.db_compact() if archived else 0
+        return {"archived": archived, "freed_pages": freed_pages}
+
+    # -------------------------
+    # Backup
+    # -------------------------
+    def backup_create(self, dest_dir: str, keep: int) -> Dict[str, Any]:
+        """
+        Онлайн-бэкап через sqlite backup API: по BACKUP_STEP_PAGES страниц с паузой
+        между шагами, затем gzip. Хранятся последние keep снимков.
+        Долгий вызов — запускать в отдельном потоке, а не в пуле БД (см. run_backup).
+        Только чтение: буфер событий сбрасывает run_backup до вызова, через пул записи.
+        """
+        out_dir = Path(dest_dir)
+        out_dir.mkdir(parents=True, exist_ok=True)
+        stem = Path(self.db_path).stem
+        stamp = now_tz().strftime("%Y%m%d_%H%M%S")
+        tmp_path = out_dir / f"{stem}_{stamp}.db.tmp"
+        gz_path = out_dir / f"{stem}_{stamp}.db.gz"
+        # Сжатие пишется во временный файл: готовый снимок появляется только целиком
+        part_path = out_dir / f"{stem}_{stamp}.db.gz.part"
+        started = time.perf_counter()
+
+        try:
+            src = self._connect_read()
+            dst = sqlite3.connect(str(tmp_path))
+            try:
+                # Открытая читающая транзакция фиксирует снимок WAL: запись идёт
+                # дальше, а копирование не перезапускается с нуля после каждого commit
+                src.execute("BEGIN")
+                src.execute("SELECT 1 FROM sqlite_master LIMIT 1").fetchone()
+                src.backup(
+                    dst,
+                    pages=BACKUP_STEP_PAGES,
+                    progress=lambda status, remaining, total: time.sleep(BACKUP_STEP_SLEEP),
+                )
+                src.rollback()
+            finally:
+                dst.close()
+                src.close()
+
+            with open(tmp_path, "rb") as f_in, gzip.open(part_path, "wb", compresslevel=6) as f_out:
+                shutil.copyfileobj(f_in, f_out, 1024 * 1024)
+            os.replace(part_path, gz_path)
+        finally:
+            part_path.unlink(missing_ok=True)
+            tmp_path.unlink(missing_ok=True)
+            Path(f"{tmp_path}-journal").unlink(missing_ok=True)
+
+        # Имя с меткой времени — сортировка по имени совпадает с хронологией
+        snapshots = sorted(out_dir.glob(f"{stem}_*.db.gz"))
+        for old in snapshots[:-keep]:
+            old.unlink(missing_ok=True)
+
+        return {
+            "path": str(gz_path),
+            "size": gz_path.stat().st_size,
+            "seconds": round(time.perf_counter() - started, 1),
+            "kept": min(len(snapshots), keep),
+        }
 
     # -------------------------
     # Cart
@@ -622,23 +1741,34 @@ class Database:
         size: str = "",
         photo_file_id: str = "",
     ) -> int:
+        """
+        Тот же товар и размер не добавляет новую строку, а увеличивает qty
+        (ключ user_id + product_id + size). Товары без product_id — отдельными строками.
+        """
         conn = self._get_conn()
         cur = conn.cursor()
         cur.execute("""
             INSERT INTO carts (user_id, product_id, product_name, price, qty, size, photo_file_id, added_at)
             VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT(user_id, product_id, size) DO UPDATE SET
+                qty=qty + excluded.qty,
+                product_name=excluded.product_name,
+                price=excluded.price,
+                photo_file_id=excluded.photo_file_id,
+                added_at=excluded.added_at
+            RETURNING id
         """, (
             user_id,
             product_id,
             product_name,
             safe_int(price),
             max(1, safe_int(qty, 1)),
-            size,
+            size or "",
             photo_file_id,
             now_str(),
         ))
+        cart_id = cur.fetchone()["id"]
         conn.commit()
-        cart_id = cur.lastrowid
         self.event_add(user_id, "cart_add", {
             "product_id": product_id,
             "product_name": product_name,
@@ -678,19 +1808,86 @@ class Database:
             conn.execute("UPDATE carts SET qty=? WHERE id=? AND user_id=?", (qty, cart_id, user_id))
         conn.commit()
 
+    def carts_expire(self, ttl_days: int, batch_size: int = 200) -> Dict[str, int]:
+        """
+        Удаляет брошенные корзины: последнее добавление старше ttl_days.
+        Кандидаты — пользователи со старыми строками (диапазон по idx_carts_added_at),
+        ищутся без блокировки; удаление — короткими транзакциями
+        по batch_size пользователей. На каждую корзину пишется событие
+        cart_abandoned с итогами, чтобы аналитика конверсии не теряла данные.
+        """
+        cutoff = (now_tz() - timedelta(days=ttl_days)).strftime("%Y-%m-%d %H:%M:%S")
+        conn = self._get_conn()
+        # INDEXED BY: с DISTINCT и OR планировщик предпочитает полный скан по idx_carts_user_product_size
+        user_ids = [r["user_id"] for r in conn.execute("""
+            SELECT user_id FROM carts INDEXED BY idx_carts_added_at WHERE added_at < ?
+            UNION
+            SELECT user_id FROM carts INDEXED BY idx_carts_added_at WHERE added_at IS NULL
+        """, (cutoff,)).fetchall()]
+
+        expired_carts = 0
+        expired_rows = 0
+        for i in range(0, len(user_ids), batch_size):
+            chunk = user_ids[i:i + batch_size]
+            marks = ",".join("?" * len(chunk))
+            with self._transaction(conn) as cur:
+                # У кандидата могут быть и свежие строки, а пока шёл поиск он мог
+                # снова что-то добавить — брошенной считается корзина целиком
+                rows = cur.execute(f"""
+                    SELECT user_id, COUNT(*) AS lines, SUM(COALESCE(qty, 1)) AS qty,
+                           SUM(COALESCE(price, 0) * COALESCE(qty, 1)) AS amount, MAX(added_at) AS last_added_at
+                    FROM carts
+                    WHERE user_id IN ({marks})
+                    GROUP BY user_id
+                    HAVING MAX(COALESCE(added_at, '')) < ?
+                """, (*chunk, cutoff)).fetchall()
+                if not rows:
+                    continue
+
+                stale = [r["user_id"] for r in rows]
+                cur.execute(
+                    f"DELETE FROM carts WHERE user_id IN ({','.join('?' * len(stale))})",
+                    stale,
+                )
+                expired_rows += cur.rowcount
+                expired_carts += len(stale)
+
+                created = now_str()
+                self._events_insert(cur, [
+                    (
+                        r["user_id"],
+                        "cart_abandoned",
+                        json.dumps({
+                            "lines": safe_int(r["lines"]),
+                            "qty": safe_int(r["qty"]),
+                            "amount": safe_int(r["amount"]),
+                            "last_added_at": r["last_added_at"],
+                        }, ensure_ascii=False),
+                        created,
+                    )
+                    for r in rows
+                ])
+
+        return {"carts": expired_carts, "rows": expired_rows}
+
     def cart_totals(self, user_id: int) -> Dict[str, int]:
-        cart = self.cart_get(user_id)
-        total_qty = sum(safe_int(x.get("qty"), 1) for x in cart)
-        total_amount = sum(safe_int(x.get("price"), 0) * safe_int(x.get("qty"), 1) for x in cart)
-        return {"total_qty": total_qty, "total_amount": total_amount}
+        conn = self._get_conn()
+        row = conn.execute("""
+            SELECT COALESCE(SUM(COALESCE(qty, 1)), 0) AS total_qty,
+                   COALESCE(SUM(COALESCE(price, 0) * COALESCE(qty, 1)), 0) AS total_amount
+            FROM carts
+            WHERE user_id=?
+        """, (user_id,)).fetchone()
+        return {"total_qty": safe_int(row["total_qty"]), "total_amount": safe_int(row["total_amount"])}
 
     # -------------------------
     # Orders
     # -------------------------
-    def order_create(self, data: Dict[str, Any]) -> int:
-        conn = self._get_conn()
-        cur = conn.cursor()
-
+    def _order_insert(self, cur: sqlite3.Cursor, data: Dict[str, Any]) -> int:
+        """
+        INSERT заказа и события order_created на курсоре открытой транзакции.
+        Commit делает вызывающий метод.
+        """
         items_raw = data.get("items", [])
         if isinstance(items_raw, str):
             try:
@@ -721,9 +1918,9 @@ class Database:
                 latitude, longitude, pvz_code, pvz_address,
                 payment_method, payment_status, payment_provider_invoice_id, payment_provider_url,
                 comment, status, manager_seen, manager_id, source,
-                created_at, updated_at
+                created_at, updated_at, created_ts, updated_ts
             )
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
         """, (
             data.get("user_id"),
             data.get("username", ""),
@@ -754,18 +1951,163 @@ class Database:
             data.get("source", "bot"),
             created,
             created,
+            to_ts(created),
+            to_ts(created),
         ))
-        conn.commit()
 
         order_id = cur.lastrowid
-        self.event_add(data.get("user_id"), "order_created", {
-            "order_id": order_id,
-            "source": data.get("source", "bot"),
-            "payment_method": data.get("payment_method", ""),
-            "delivery_type": data.get("delivery_type", ""),
-        })
+        self._events_insert(cur, [(
+            data.get("user_id"),
+            "order_created",
+            json.dumps({
+                "order_id": order_id,
+                "source": data.get("source", "bot"),
+                "payment_method": data.get("payment_method", ""),
+                "delivery_type": data.get("delivery_type", ""),
+            }, ensure_ascii=False),
+            created,
+        )])
+        self._order_items_insert(cur, order_id, items_list, created)
+        self._orders_fts_index(cur, order_id, data)
+
+        day = created[:10]
+        amount = safe_int(total_amount)
+        self._rollup_order_add(cur, day, "status", data.get("status", "new"), 1, amount)
+        self._rollup_order_add(cur, day, "city", data.get("city", ""), 1, amount)
+        self._rollup_order_add(cur, day, "payment", data.get("payment_method", ""), 1, amount)
+        self._rollup_order_add(cur, day, "delivery", data.get("delivery_type", ""), 1, amount)
+
+        self._counter_add(cur, "total", 1)
+        status_key = STATS_STATUS_KEYS.get(data.get("status", "new"))
+        if status_key:
+            self._counter_add(cur, status_key, 1)
+        if data.get("user_id") is not None:
+            cur.execute("INSERT OR IGNORE INTO order_customers (user_id) VALUES (?)", (data.get("user_id"),))
+            if cur.rowcount == 1:
+                self._counter_add(cur, "unique_users", 1)
         return order_id
 
+    def _order_items_insert(
+        self,
+        cur: Union[sqlite3.Cursor, sqlite3.Connection],
+        order_id: int,
+        items: List[Dict],
+        created_at: str,
+    ) -> None:
+        created_ts = to_ts(created_at)
+        rows = []
+        for line_no, item in enumerate(items, start=1):
+            if not isinstance(item, dict):
+                continue
+            rows.append((
+                order_id,
+                line_no,
+                safe_int(item.get("product_id"), 0) or None,
+                (item.get("product_name") or item.get("name") or "").strip(),
+                item.get("size") or "",
+                safe_int(item.get("price"), 0),
+                safe_int(item.get("qty"), 1),
+                created_at,
+                created_ts,
+            ))
+        if not rows:
+            return
+        cur.executemany("""
+            INSERT INTO order_items (order_id, line_no, product_id, product_name, size, price, qty, created_at, created_ts)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """, rows)
+
+    @db_read
+    def order_items_by_orders(self, order_ids: List[int]) -> Dict[int, List[Dict]]:
+        result: Dict[int, List[Dict]] = {}
+        conn = self._get_read_conn()
+        ids = list(dict.fromkeys(order_ids))
+        for i in range(0, len(ids), 500):
+            chunk = ids[i:i + 500]
+            rows = conn.execute(f"""
+                SELECT * FROM order_items
+                WHERE order_id IN ({",".join("?" * len(chunk))})
+                ORDER BY order_id, line_no
+            """, tuple(chunk)).fetchall()
+            for r in rows:
+                result.setdefault(r["order_id"], []).append(dict(r))
+        return result
+
+    def order_create(self, data: Dict[str, Any]) -> int:
+        conn = self._get_conn()
+        with self._transaction(conn) as cur:
+            return self._order_insert(cur, data)
+
+    def order_place(
+        self,
+        data: Dict[str, Any],
+        idempotency_key: str = "",
+        request_hash: str = "",
+    ) -> Tuple[Optional[Dict], bool]:
+        """
+        Создаёт заказ и возвращает (строка заказа, создан ли он сейчас).
+        С idempotency_key повтор в пределах IDEMPOTENCY_TTL_HOURS не создаёт второй заказ,
+        а возвращает первый с False — только если request_hash совпал. Тот же ключ
+        с другим телом запроса даёт (None, False): чужой или устаревший ключ не выдаёт
+        существующий заказ. BEGIN IMMEDIATE не пускает параллельный повтор
+        между проверкой ключа и его записью.
+        """
+        conn = self._get_conn()
+        now_ts = int(time.time())
+        with self._transaction(conn) as cur:
+            if idempotency_key:
+                cur.execute(
+                    "DELETE FROM order_idempotency WHERE created_ts < ?",
+                    (now_ts - IDEMPOTENCY_TTL_HOURS * 3600,),
+                )
+                seen = cur.execute(
+                    "SELECT order_id, request_hash FROM order_idempotency WHERE key=?", (idempotency_key,)
+                ).fetchone()
+                # Пустой хеш — ключ записан до появления колонки, сравнивать не с чем
+                if seen and seen["request_hash"] and seen["request_hash"] != request_hash:
+                    return None, False
+                if seen:
+                    row = cur.execute("SELECT * FROM orders WHERE id=?", (seen["order_id"],)).fetchone()
+                    if row:
+                        return dict(row), False
+
+            order_id = self._order_insert(cur, data)
+            if idempotency_key:
+                cur.execute("""
+                    INSERT OR REPLACE INTO order_idempotency (key, order_id, created_ts, request_hash)
+                    VALUES (?, ?, ?, ?)
+                """, (idempotency_key, order_id, now_ts, request_hash))
+            row = cur.execute("SELECT * FROM orders WHERE id=?", (order_id,)).fetchone()
+            return dict(row), True
+
+    def checkout_from_cart(self, user_id: int, data: Dict[str, Any]) -> Optional[Dict]:
+        """
+        Оформление заказа из корзины одной транзакцией:
+        чтение корзины, итоги, заказ, событие order_created и очистка корзины.
+        Возвращает созданный заказ или None, если корзина пуста.
+        """
+        conn = self._get_conn()
+        with self._transaction(conn) as cur:
+            cart = [dict(r) for r in cur.execute("""
+                SELECT * FROM carts
+                WHERE user_id=?
+                ORDER BY id DESC
+            """, (user_id,)).fetchall()]
+            if not cart:
+                return None
+
+            items = cart_to_order_items(cart)
+            order_id = self._order_insert(cur, {
+                **data,
+                "user_id": user_id,
+                "items": items,
+                "total_qty": sum(x["qty"] for x in items),
+                "total_amount": sum(x["price"] * x["qty"] for x in items),
+            })
+            cur.execute("DELETE FROM carts WHERE user_id=?", (user_id,))
+            row = cur.execute("SELECT * FROM orders WHERE id=?", (order_id,)).fetchone()
+            return dict(row)
+
     def order_get(self, order_id: int) -> Optional[Dict]:
         conn = self._get_conn()
         row = conn.execute("SELECT * FROM orders WHERE id=?", (order_id,)).fetchone()
@@ -781,8 +2123,9 @@ class Database:
         """, (user_id, limit)).fetchall()
         return [dict(r) for r in rows]
 
+    @db_read
     def orders_get_by_status(self, status: str, limit: int = 50) -> List[Dict]:
-        conn = self._get_conn()
+        conn = self._get_read_conn()
         rows = conn.execute("""
             SELECT * FROM orders
             WHERE status=?
@@ -793,19 +2136,40 @@ class Database:
 
     def order_update_status(self, order_id: int, status: str, manager_id: Optional[int] = None) -> None:
         conn = self._get_conn()
-        if manager_id is None:
-            conn.execute("""
-                UPDATE orders
-                SET status=?, updated_at=?
-                WHERE id=?
-            """, (status, now_str(), order_id))
-        else:
-            conn.execute("""
-                UPDATE orders
-                SET status=?, manager_id=?, manager_seen=1, updated_at=?
-                WHERE id=?
-            """, (status, manager_id, now_str(), order_id))
-        conn.commit()
+        with self._transaction(conn) as cur:
+            row = cur.execute("""
+                SELECT status, created_at, total_amount FROM orders WHERE id=?
+            """, (order_id,)).fetchone()
+            if not row:
+                return
+
+            updated = now_str()
+            if manager_id is None:
+                cur.execute("""
+                    UPDATE orders
+                    SET status=?, updated_at=?, updated_ts=?
+                    WHERE id=?
+                """, (status, updated, to_ts(updated), order_id))
+            else:
+                cur.execute("""
+                    UPDATE orders
+                    SET status=?, manager_id=?, manager_seen=1, updated_at=?, updated_ts=?
+                    WHERE id=?
+                """, (status, manager_id, updated, to_ts(updated), order_id))
+
+            if row["status"] != status:
+                old_key = STATS_STATUS_KEYS.get(row["status"])
+                new_key = STATS_STATUS_KEYS.get(status)
+                if old_key:
+                    self._counter_add(cur, old_key, -1)
+                if new_key:
+                    self._counter_add(cur, new_key, 1)
+
+                if row["created_at"]:
+                    day = row["created_at"][:10]
+                    amount = safe_int(row["total_amount"])
+                    self._rollup_order_add(cur, day, "status", row["status"], -1, -amount)
+                    self._rollup_order_add(cur, day, "status", status, 1, amount)
 
     def order_update_payment(
         self,
@@ -814,60 +2178,170 @@ class Database:
         payment_provider_invoice_id: str = "",
         payment_provider_url: str = "",
     ) -> None:
+        updated = now_str()
         conn = self._get_conn()
         conn.execute("""
             UPDATE orders
-            SET payment_status=?, payment_provider_invoice_id=?, payment_provider_url=?, updated_at=?
+            SET payment_status=?, payment_provider_invoice_id=?, payment_provider_url=?,
+                updated_at=?, updated_ts=?
             WHERE id=?
         """, (
             payment_status,
             payment_provider_invoice_id,
             payment_provider_url,
-            now_str(),
+            updated,
+            to_ts(updated),
             order_id,
         ))
         conn.commit()
 
     def order_mark_seen(self, order_id: int, manager_id: int) -> None:
+        updated = now_str()
         conn = self._get_conn()
         conn.execute("""
             UPDATE orders
-            SET manager_seen=1, manager_id=?, updated_at=?
+            SET manager_seen=1, manager_id=?, updated_at=?, updated_ts=?
             WHERE id=?
-        """, (manager_id, now_str(), order_id))
+        """, (manager_id, updated, to_ts(updated), order_id))
         conn.commit()
 
+    def _fts_match_expr(self, terms: Dict[str, str]) -> str:
+        """
+        {колонка: подстрока} -> выражение MATCH. Trigram ищет подстроку
+        (а значит, и префикс) длиной от 3 символов; более короткие значения
+        в выражение не попадают и проверяются через LIKE.
+        """
+        return " AND ".join(
+            f"{column} : {fts_phrase(value)}"
+            for column, value in terms.items()
+            if len(value) >= 3
+        )
+
+    @db_read
+    def orders_search(self, query: str, limit: int = 20) -> List[Dict]:
+        """
+        Поиск заказов по телефону, имени, городу, адресу и комментарию.
+        Совпадения ранжируются bm25, при равенстве — новые выше.
+        """
+        query = (query or "").strip()
+        if not query:
+            return []
+
+        conn = self._get_read_conn()
+        if self.fts_enabled and len(query) >= 3:
+            match = fts_phrase(query)
+            digits = phone_digits(query)
+            if len(digits) >= 3 and digits != query:
+                match += f" OR phone_digits : {fts_phrase(digits)}"
+            rows = conn.execute("""
+                SELECT o.* FROM orders_fts f
+                JOIN orders o ON o.id = f.rowid
+                WHERE orders_fts MATCH ?
+                ORDER BY f.rank, o.id DESC
+                LIMIT ?
+            """, (match, limit)).fetchall()
+            return [dict(r) for r in rows]
+
+        like = f"%{query}%"
+        rows = conn.execute("""
+            SELECT * FROM orders
+            WHERE customer_phone LIKE ? OR customer_name LIKE ? OR city LIKE ?
+               OR delivery_address LIKE ? OR comment LIKE ?
+            ORDER BY id DESC
+            LIMIT ?
+        """, (like, like, like, like, like, limit)).fetchall()
+        return [dict(r) for r in rows]
+
+    @db_read
     def orders_filter(
         self,
         status: str = "",
         city: str = "",
         phone_q: str = "",
-        limit: int = 200,
-    ) -> List[Dict]:
-        conn = self._get_conn()
-        q = "SELECT * FROM orders WHERE 1=1"
+        page_size: int = 50,
+        cursor: str = "",
+    ) -> Dict[str, Any]:
+        """
+        Страница заказов (новые сверху) с keyset-пагинацией по id.
+        cursor: "" — первая страница, "b<id>" — заказы старше id, "a<id>" — новее id.
+        Возвращает {"rows", "next_cursor" (старее), "prev_cursor" (новее)}.
+        """
+        page_size = max(1, page_size)
+        direction = cursor[:1] if cursor[:1] in ("a", "b") else ""
+        cursor_id = safe_int(cursor[1:]) if direction else 0
+
+        conn = self._get_read_conn()
+        q = "SELECT o.* FROM orders o WHERE 1=1"
         args: List[Any] = []
 
+        city = city.strip()
+        digits = phone_digits(phone_q)
+        match = ""
+        if self.fts_enabled:
+            match = self._fts_match_expr({"city": city, "phone_digits": digits})
+        if match:
+            q = """
+                SELECT o.* FROM orders_fts f
+                JOIN orders o ON o.id = f.rowid
+                WHERE orders_fts MATCH ?
+            """
+            args.append(match)
+
         if status:
-            q += " AND status=?"
+            q += " AND o.status=?"
             args.append(status)
 
-        if city:
-            q += " AND city LIKE ?"
+        if city and (not match or len(city) < 3):
+            q += " AND o.city LIKE ?"
             args.append(f"%{city}%")
 
-        if phone_q:
-            q += " AND customer_phone LIKE ?"
+        if phone_q and (not match or len(digits) < 3):
+            q += " AND o.customer_phone LIKE ?"
             args.append(f"%{phone_q}%")
 
-        q += " ORDER BY id DESC LIMIT ?"
-        args.append(limit)
-
-        rows = conn.execute(q, tuple(args)).fetchall()
-        return [dict(r) for r in rows]
-
+        if direction == "a":
+            q += " AND o.id > ? ORDER BY o.id ASC LIMIT ?"
+            args.extend([cursor_id, page_size + 1])
+        elif direction == "b":
+            q += " AND o.id < ? ORDER BY o.id DESC LIMIT ?"
+            args.extend([cursor_id, page_size + 1])
+        else:
+            q += " ORDER BY o.id DESC LIMIT ?"
+            args.append(page_size + 1)
+
+        rows = [dict(r) for r in conn.execute(q, tuple(args)).fetchall()]
+        has_more = len(rows) > page_size
+        rows = rows[:page_size]
+        if direction == "a":
+            rows.reverse()
+
+        next_cursor = prev_cursor = None
+        if rows:
+            if direction == "a" or has_more:
+                next_cursor = f"b{rows[-1]['id']}"
+            if direction == "b" or (direction == "a" and has_more):
+                prev_cursor = f"a{rows[0]['id']}"
+        elif direction == "b":
+            prev_cursor = f"a{cursor_id - 1}"
+        elif direction == "a":
+            next_cursor = f"b{cursor_id + 1}"
+
+        return {"rows": rows, "next_cursor": next_cursor, "prev_cursor": prev_cursor}
+
+    @db_read
     def find_orders_by_phone(self, phone_part: str, limit: int = 20) -> List[Dict]:
-        conn = self._get_conn()
+        conn = self._get_read_conn()
+        digits = phone_digits(phone_part)
+        if self.fts_enabled and len(digits) >= 3:
+            rows = conn.execute("""
+                SELECT o.* FROM orders_fts f
+                JOIN orders o ON o.id = f.rowid
+                WHERE orders_fts MATCH ?
+                ORDER BY f.rank, o.id DESC
+                LIMIT ?
+            """, (f"phone_digits : {fts_phrase(digits)}", limit)).fetchall()
+            return [dict(r) for r in rows]
+
         rows = conn.execute("""
             SELECT * FROM orders
             WHERE customer_phone LIKE ?
@@ -877,37 +2351,66 @@ class Database:
         return [dict(r) for r in rows]
 
     def orders_get_for_reminder(self) -> List[Dict]:
+        # Условие повторяет WHERE частичного индекса idx_orders_unseen_new:
+        # без ANALYZE планировщик выбрал бы idx_orders_status, поэтому индекс задан явно
         conn = self._get_conn()
-        cutoff = (now_tz() - timedelta(minutes=30)).strftime("%Y-%m-%d %H:%M:%S")
+        cutoff = int((now_tz() - REMINDER_AFTER).timestamp())
         rows = conn.execute("""
-            SELECT * FROM orders
+            SELECT * FROM orders INDEXED BY idx_orders_unseen_new
             WHERE status='new'
               AND manager_seen=0
-              AND created_at < ?
-              AND (reminded_at IS NULL OR reminded_at < ?)
+              AND created_ts < ?
+              AND (reminded_ts IS NULL OR reminded_ts < ?)
             ORDER BY id DESC
         """, (cutoff, cutoff)).fetchall()
         return [dict(r) for r in rows]
 
-    def order_update_reminded(self, order_id: int) -> None:
+    def orders_mark_reminded(self, order_ids: List[int]) -> int:
+        """Отмечает напоминание сразу для пачки заказов одним UPDATE."""
+        ids = [int(x) for x in order_ids]
+        if not ids:
+            return 0
         conn = self._get_conn()
-        conn.execute("""
-            UPDATE orders
-            SET reminded_at=?, updated_at=?
-            WHERE id=?
-        """, (now_str(), now_str(), order_id))
-        conn.commit()
+        stamp = now_str()
+        ts = to_ts(stamp)
+        total = 0
+        with self._transaction(conn):
+            for i in range(0, len(ids), 500):
+                chunk = ids[i:i + 500]
+                marks = ",".join("?" * len(chunk))
+                cur = conn.execute(f"""
+                    UPDATE orders
+                    SET reminded_at=?, updated_at=?, reminded_ts=?, updated_ts=?
+                    WHERE id IN ({marks})
+                """, (stamp, stamp, ts, ts, *chunk))
+                total += cur.rowcount
+        return total
+
+    def orders_next_reminder_at(self) -> Optional[datetime]:
+        """
+        Момент, когда ближайший непросмотренный новый заказ станет «просроченным»:
+        max(created_at, reminded_at) + REMINDER_AFTER. None — таких заказов нет.
+        """
+        conn = self._get_conn()
+        row = conn.execute("""
+            SELECT MIN(MAX(created_ts, COALESCE(reminded_ts, 0))) AS base
+            FROM orders INDEXED BY idx_orders_unseen_new
+            WHERE status='new' AND manager_seen=0
+        """).fetchone()
+        if not row or not row["base"]:
+            return None
+        return datetime.fromtimestamp(row["base"], TZ) + REMINDER_AFTER
 
+    @db_read
     def orders_get_monthly(self, year: int, month: int) -> List[Dict]:
-        conn = self._get_conn()
-        start = f"{year}-{month:02d}-01 00:00:00"
-        last_day = monthrange(year, month)[1]
-        end = f"{year}-{month:02d}-{last_day} 23:59:59"
+        conn = self._get_read_conn()
+        start = datetime(year, month, 1, tzinfo=TZ)
+        end = datetime(year + month // 12, month % 12 + 1, 1, tzinfo=TZ)
         rows = conn.execute("""
             SELECT * FROM orders
-            WHERE created_at BETWEEN ? AND ?
+            WHERE created_ts >= ? AND created_ts < ?
             ORDER BY id ASC
-        """, (start, end)).fetchall()
+        """, (int(start.timestamp()), int(end.timestamp()))).fetchall()
         return [dict(r) for r in rows]
 
     # -------------------------
@@ -929,8 +2432,13 @@ class Database:
         """, (year, month)).fetchone()
         return row is not None
 
-    def get_stats_all(self) -> Dict[str, int]:
-        conn = self._get_conn()
+    def _counter_add(self, cur: sqlite3.Cursor, name: str, delta: int) -> None:
+        cur.execute("""
+            INSERT INTO order_counters (name, value) VALUES (?, ?)
+            ON CONFLICT(name) DO UPDATE SET value=value + excluded.value
+        """, (name, delta))
+
+    def _stats_counters_rebuild(self, conn: sqlite3.Connection) -> Dict[str, int]:
         row = conn.execute("""
             SELECT
                 COUNT(*) AS total,
@@ -944,83 +2452,182 @@ class Database:
                 COUNT(DISTINCT user_id) AS unique_users
             FROM orders
         """).fetchone()
+        expected = {k: safe_int(row[k]) for k in STATS_KEYS}
+        current = {
+            r["name"]: safe_int(r["value"])
+            for r in conn.execute("SELECT name, value FROM order_counters").fetchall()
+        }
 
-        if not row:
-            return {
-                "total": 0,
-                "new_count": 0,
-                "processing": 0,
-                "confirmed": 0,
-                "paid_count": 0,
-                "shipped": 0,
-                "delivered": 0,
-                "cancelled": 0,
-                "unique_users": 0,
-            }
-        return dict(row)
+        conn.execute("DELETE FROM order_counters")
+        conn.executemany(
+            "INSERT INTO order_counters (name, value) VALUES (?, ?)",
+            list(expected.items()),
+        )
+        conn.execute("DELETE FROM order_customers")
+        conn.execute("""
+            INSERT INTO order_customers (user_id)
+            SELECT DISTINCT user_id FROM orders WHERE user_id IS NOT NULL
+        """)
 
-    def stats_range(self, start: str, end: str) -> Dict[str, int]:
-        conn = self._get_conn()
-        row = conn.execute("""
-            SELECT
-                COUNT(*) AS total,
-                SUM(CASE WHEN status='new' THEN 1 ELSE 0 END) AS new_count,
-                SUM(CASE WHEN status='processing' THEN 1 ELSE 0 END) AS processing,
-                SUM(CASE WHEN status='confirmed' THEN 1 ELSE 0 END) AS confirmed,
-                SUM(CASE WHEN status='paid' THEN 1 ELSE 0 END) AS paid_count,
-                SUM(CASE WHEN status='shipped' THEN 1 ELSE 0 END) AS shipped,
-                SUM(CASE WHEN status='delivered' THEN 1 ELSE 0 END) AS delivered,
-                SUM(CASE WHEN status='cancelled' THEN 1 ELSE 0 END) AS cancelled
-            FROM orders
-            WHERE created_at BETWEEN ? AND ?
-        """, (start, end)).fetchone()
-        return dict(row) if row else {}
+        return {
+            k: current.get(k, 0) - v
+            for k, v in expected.items()
+            if current.get(k, 0) != v
+        }
 
-    def top_products_range(self, start: str, end: str, limit: int = 10) -> List[Tuple[str, int]]:
+    def stats_counters_rebuild(self) -> Dict[str, int]:
+        """
+        Пересчитывает счётчики заказов полным сканом orders.
+        Возвращает расхождение {счётчик: было - стало}; пустой dict — дрейфа нет.
+        """
         conn = self._get_conn()
-        rows = conn.execute("""
-            SELECT items FROM orders
-            WHERE created_at BETWEEN ? AND ?
-        """, (start, end)).fetchall()
-
-        counter: Dict[str, int] = {}
-        for row in rows:
-            try:
-                items = json.loads(row["items"] or "[]")
-            except Exception:
-                items = []
-            for item in items:
-                name = (item.get("product_name") or item.get("name") or "").strip()
-                qty = safe_int(item.get("qty"), 1)
-                if name:
-                    counter[name] = counter.get(name, 0) + qty
-
-        return sorted(counter.items(), key=lambda x: x[1], reverse=True)[:limit]
+        with self._transaction(conn):
+            return self._stats_counters_rebuild(conn)
 
-    def top_cities_range(self, start: str, end: str, limit: int = 10) -> List[Tuple[str, int]]:
+    @db_read
+    def get_stats_all(self) -> Dict[str, int]:
+        conn = self._get_read_conn()
+        rows = conn.execute("SELECT name, value FROM order_counters").fetchall()
+        stats = {k: 0 for k in STATS_KEYS}
+        for r in rows:
+            if r["name"] in stats:
+                stats[r["name"]] = safe_int(r["value"])
+        return stats
+
+    def _rollup_order_add(self, cur: sqlite3.Cursor, day: str, dim: str, value: Any, orders: int, amount: int) -> None:
+        cur.execute("""
+            INSERT INTO rollup_orders_daily (day, dim, value, orders, amount) VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT(day, dim, value) DO UPDATE SET
+                orders=orders + excluded.orders,
+                amount=amount + excluded.amount
+        """, (day, dim, value or "", orders, amount))
+
+    def _rollups_rebuild(self, conn: sqlite3.Connection) -> None:
+        conn.execute("DELETE FROM rollup_orders_daily")
+        for dim, column in ROLLUP_ORDER_DIMS.items():
+            conn.execute(f"""
+                INSERT INTO rollup_orders_daily (day, dim, value, orders, amount)
+                SELECT substr(created_at, 1, 10), ?, COALESCE({column}, ''), COUNT(*), COALESCE(SUM(total_amount), 0)
+                FROM orders
+                WHERE created_at IS NOT NULL
+                GROUP BY substr(created_at, 1, 10), COALESCE({column}, '')
+            """, (dim,))
+
+        # Дни, чьи события уже ушли в архив (events_archive), пересчитать не из чего:
+        # их агрегаты не трогаем, пересобираем начиная с первого дня в events
+        first_day = conn.execute("SELECT substr(MIN(created_at), 1, 10) FROM events").fetchone()[0]
+        if first_day:
+            conn.execute("DELETE FROM rollup_events_daily WHERE day >= ?", (first_day,))
+            conn.execute("""
+                INSERT INTO rollup_events_daily (day, event_type, cnt)
+                SELECT substr(created_at, 1, 10), COALESCE(event_type, ''), COUNT(*)
+                FROM events
+                WHERE created_at IS NOT NULL
+                GROUP BY substr(created_at, 1, 10), COALESCE(event_type, '')
+            """)
+
+    def rollups_rebuild(self) -> None:
+        """Пересобирает дневные rollup-таблицы из сырых orders и events."""
+        self.events_flush()
         conn = self._get_conn()
+        with self._transaction(conn):
+            self._rollups_rebuild(conn)
+
+    @db_read
+    def orders_breakdown_range(self, start: str, end: str, dim: str) -> Dict[str, Tuple[int, int]]:
+        """
+        Заказы за период в разрезе dim (status / city / payment / delivery):
+        {значение: (кол-во заказов, сумма)}. Целые дни берутся из
+        rollup_orders_daily, неполные края — из orders.
+        """
+        column = ROLLUP_ORDER_DIMS[dim]
+        conn = self._get_read_conn()
+        days, edges = split_range_by_days(start, end)
+        result: Dict[str, Tuple[int, int]] = {}
+
+        def merge(rows: List[sqlite3.Row]) -> None:
+            for r in rows:
+                key = r["value"] or ""
+                orders, amount = result.get(key, (0, 0))
+                result[key] = (orders + safe_int(r["orders"]), amount + safe_int(r["amount"]))
+
+        if days:
+            merge(conn.execute("""
+                SELECT value, SUM(orders) AS orders, SUM(amount) AS amount
+                FROM rollup_orders_daily
+                WHERE dim=? AND day BETWEEN ? AND ?
+                GROUP BY value
+            """, (dim, days[0], days[1])).fetchall())
+
+        for edge_start, edge_end in edges:
+            merge(conn.execute(f"""
+                SELECT {column} AS value, COUNT(*) AS orders, SUM(total_amount) AS amount
+                FROM orders
+                WHERE created_ts BETWEEN ? AND ?
+                GROUP BY {column}
+            """, (to_ts(edge_start), to_ts(edge_end))).fetchall())
+
+        return result
+
+    @db_read
+    def stats_range(self, start: str, end: str) -> Dict[str, int]:
+        by_status = self.orders_breakdown_range(start, end, "status")
+        stats = {"total": sum(orders for orders, _ in by_status.values())}
+        for status, key in STATS_STATUS_KEYS.items():
+            stats[key] = by_status.get(status, (0, 0))[0]
+        return stats
+
+    @db_read
+    def top_products_range(self, start: str, end: str, limit: int = 10) -> List[Tuple[str, int]]:
+        conn = self._get_read_conn()
         rows = conn.execute("""
-            SELECT city, COUNT(*) AS c
-            FROM orders
-            WHERE created_at BETWEEN ? AND ?
-            GROUP BY city
-            ORDER BY c DESC
+            SELECT product_name, SUM(qty) AS q
+            FROM order_items
+            WHERE created_ts BETWEEN ? AND ?
+              AND product_name != ''
+            GROUP BY product_name
+            ORDER BY q DESC
             LIMIT ?
-        """, (start, end, limit)).fetchall()
-        return [(r["city"] or "—", safe_int(r["c"])) for r in rows]
+        """, (to_ts(start), to_ts(end), limit)).fetchall()
+        return [(r["product_name"], safe_int(r["q"])) for r in rows]
 
+    @db_read
+    def top_cities_range(self, start: str, end: str, limit: int = 10) -> List[Tuple[str, int]]:
+        by_city = self.orders_breakdown_range(start, end, "city")
+        top = sorted(by_city.items(), key=lambda x: x[1][0], reverse=True)[:limit]
+        return [(city or "—", orders) for city, (orders, _) in top]
+
+    @db_read
     def funnel_range(self, start: str, end: str) -> Dict[str, float]:
-        conn = self._get_conn()
-        row = conn.execute("""
-            SELECT
-                SUM(CASE WHEN event_type='cart_add' THEN 1 ELSE 0 END) AS cart_add,
-                SUM(CASE WHEN event_type='order_created' THEN 1 ELSE 0 END) AS order_created
-            FROM events
-            WHERE created_at BETWEEN ? AND ?
-        """, (start, end)).fetchone()
-
-        cart_add = safe_int(row["cart_add"] if row else 0)
-        order_created = safe_int(row["order_created"] if row else 0)
+        self.events_flush()
+        conn = self._get_read_conn()
+        days, edges = split_range_by_days(start, end)
+        counts = {"cart_add": 0, "order_created": 0}
+
+        if days:
+            rows = conn.execute("""
+                SELECT event_type, SUM(cnt) AS c
+                FROM rollup_events_daily
+                WHERE day BETWEEN ? AND ?
+                  AND event_type IN ('cart_add', 'order_created')
+                GROUP BY event_type
+            """, days).fetchall()
+            for r in rows:
+                counts[r["event_type"]] += safe_int(r["c"])
+
+        for edge_start, edge_end in edges:
+            rows = conn.execute("""
+                SELECT event_type, COUNT(*) AS c
+                FROM events
+                WHERE event_type IN ('cart_add', 'order_created')
+                  AND created_ts BETWEEN ? AND ?
+                GROUP BY event_type
+            """, (to_ts(edge_start), to_ts(edge_end))).fetchall()
+            for r in rows:
+                counts[r["event_type"]] += safe_int(r["c"])
+
+        cart_add = counts["cart_add"]
+        order_created = counts["order_created"]
         conversion = round((order_created / cart_add * 100.0), 2) if cart_add > 0 else 0.0
 
         return {
@@ -1097,36 +2704,38 @@ class Database:
             category_slug = "casual"
 
         conn = self._get_conn()
-        cur = conn.cursor()
-        cur.execute("""
-            INSERT INTO shop_products (
-                photo_file_id, title_ru, title_uz,
-                description_ru, description_uz,
-                sizes, category_slug,
-                price, old_price, price_on_request, stock_qty,
-                is_published, sort_order,
-                created_at, updated_at
-            )
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-        """, (
-            photo_file_id,
-            title_ru.strip(),
-            title_uz.strip(),
-            description_ru.strip(),
-            description_uz.strip(),
-            sizes.strip(),
-            category_slug,
-            safe_int(price),
-            safe_int(old_price),
-            safe_int(price_on_request),
-            safe_int(stock_qty),
-            safe_int(is_published, 1),
-            safe_int(sort_order),
-            now_str(),
-            now_str(),
-        ))
-        conn.commit()
-        return cur.lastrowid
+        with self._transaction(conn) as cur:
+            cur.execute("""
+                INSERT INTO shop_products (
+                    photo_file_id, title_ru, title_uz,
+                    description_ru, description_uz,
+                    sizes, category_slug,
+                    price, old_price, price_on_request, stock_qty,
+                    is_published, sort_order,
+                    created_at, updated_at
+                )
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            """, (
+                photo_file_id,
+                title_ru.strip(),
+                title_uz.strip(),
+                description_ru.strip(),
+                description_uz.strip(),
+                sizes.strip(),
+                category_slug,
+                safe_int(price),
+                safe_int(old_price),
+                safe_int(price_on_request),
+                safe_int(stock_qty),
+                safe_int(is_published, 1),
+                safe_int(sort_order),
+                now_str(),
+                now_str(),
+            ))
+            product_id = cur.lastrowid
+            version = self._catalog_bump(cur, product_id)
+        self._catalog_version_seen(version)
+        return product_id
 
     def shop_product_get(self, product_id: int) -> Optional[Dict]:
         conn = self._get_conn()
@@ -1136,6 +2745,21 @@ class Database:
         """, (product_id,)).fetchone()
         return dict(row) if row else None
 
+    def shop_products_get_many(self, product_ids: List[int]) -> Dict[int, Dict]:
+        """Товары по списку id одним запросом на пачку: {id: товар}, ненайденных id в ответе нет."""
+        result: Dict[int, Dict] = {}
+        conn = self._get_conn()
+        ids = list(dict.fromkeys(product_ids))
+        for i in range(0, len(ids), 500):
+            chunk = ids[i:i + 500]
+            rows = conn.execute(f"""
+                SELECT * FROM shop_products
+                WHERE id IN ({",".join("?" * len(chunk))})
+            """, tuple(chunk)).fetchall()
+            for r in rows:
+                result[r["id"]] = dict(r)
+        return result
+
     def shop_products_list(self, published_only: bool = True, limit: int = 500) -> List[Dict]:
         conn = self._get_conn()
         if published_only:
@@ -1153,6 +2777,56 @@ class Database:
             """, (limit,)).fetchall()
         return [dict(r) for r in rows]
 
+    def shop_products_page(
+        self,
+        category_slug: str = "",
+        after: Optional[Tuple[int, int]] = None,
+        limit: int = CATALOG_PAGE_SIZE,
+    ) -> List[Dict]:
+        """
+        Страница опубликованных товаров в порядке витрины (sort_order по возрастанию, id по убыванию).
+        after — ключ (sort_order, id) последнего товара прошлой страницы: keyset вместо OFFSET,
+        поэтому дальние страницы не дороже первой. Порядок совпадает с idx_products_pub_order
+        и idx_products_pub_cat_order (id DESC), так что страница читается из индекса без сортировки.
+        """
+        conn = self._get_conn()
+        where = ["is_published=1"]
+        params: List[Any] = []
+        if category_slug:
+            where.append("category_slug=?")
+            params.append(category_slug)
+        if after:
+            # sort_order >= ? даёт границу диапазона по индексу, остальное — точное условие ключа
+            where.append("sort_order >= ? AND (sort_order > ? OR id < ?)")
+            params.extend([after[0], after[0], after[1]])
+        rows = conn.execute(f"""
+            SELECT * FROM shop_products
+            WHERE {" AND ".join(where)}
+            ORDER BY sort_order ASC, id DESC
+            LIMIT ?
+        """, (*params, limit)).fetchall()
+        return [dict(r) for r in rows]
+
+    def shop_products_changed(self, since: int, limit: int) -> Tuple[List[Dict], List[int]]:
+        """
+        Изменения каталога после версии since: (изменённые товары, id удалённых).
+        Снятые с публикации товары тоже попадают в первый список — клиент убирает их сам.
+        """
+        conn = self._get_conn()
+        rows = conn.execute("""
+            SELECT * FROM shop_products
+            WHERE version > ?
+            ORDER BY version
+            LIMIT ?
+        """, (since, limit)).fetchall()
+        deleted = conn.execute("""
+            SELECT id FROM shop_products_deleted
+            WHERE version > ?
+            ORDER BY version
+            LIMIT ?
+        """, (since, limit)).fetchall()
+        return [dict(r) for r in rows], [r["id"] for r in deleted]
+
     def shop_products_count(self) -> int:
         conn = self._get_conn()
         row = conn.execute("SELECT COUNT(*) AS c FROM shop_products").fetchone()
@@ -1160,17 +2834,21 @@ class Database:
 
     def shop_product_delete(self, product_id: int) -> None:
         conn = self._get_conn()
-        conn.execute("DELETE FROM shop_products WHERE id=?", (product_id,))
-        conn.commit()
+        with self._transaction(conn) as cur:
+            cur.execute("DELETE FROM shop_products WHERE id=?", (product_id,))
+            version = self._catalog_bump(cur, product_id, deleted=True)
+        self._catalog_version_seen(version)
 
     def shop_product_update_publish(self, product_id: int, is_published: int) -> None:
         conn = self._get_conn()
-        conn.execute("""
-            UPDATE shop_products
-            SET is_published=?, updated_at=?
-            WHERE id=?
-        """, (safe_int(is_published), now_str(), product_id))
-        conn.commit()
+        with self._transaction(conn) as cur:
+            cur.execute("""
+                UPDATE shop_products
+                SET is_published=?, updated_at=?
+                WHERE id=?
+            """, (safe_int(is_published), now_str(), product_id))
+            version = self._catalog_bump(cur, product_id)
+        self._catalog_version_seen(version)
 
     def shop_product_update_field(self, product_id: int, field_name: str, value: Any) -> None:
         allowed = {
@@ -1183,64 +2861,95 @@ class Database:
             raise ValueError("Недопустимое поле для обновления")
 
         conn = self._get_conn()
-        conn.execute(
-            f"UPDATE shop_products SET {field_name}=?, updated_at=? WHERE id=?",
-            (value, now_str(), product_id)
-        )
-        conn.commit()
+        with self._transaction(conn) as cur:
+            cur.execute(
+                f"UPDATE shop_products SET {field_name}=?, updated_at=? WHERE id=?",
+                (value, now_str(), product_id)
+            )
+            version = self._catalog_bump(cur, product_id)
+        self._catalog_version_seen(version)
+
+    def _catalog_bump(self, cur: sqlite3.Cursor, product_id: int, deleted: bool = False) -> int:
+        """
+        Увеличивает версию каталога в транзакции изменения товара и помечает ею
+        сам товар (или его надгробие, если товар удалён).
+        """
+        row = cur.execute("UPDATE catalog_state SET version=version + 1 WHERE id=1 RETURNING version").fetchone()
+        version = safe_int(row["version"])
+        if deleted:
+            cur.execute(
+                "INSERT OR REPLACE INTO shop_products_deleted (id, version) VALUES (?, ?)",
+                (product_id, version),
+            )
+        else:
+            cur.execute("UPDATE shop_products SET version=? WHERE id=?", (version, product_id))
+            # id мог освободиться после удаления и достаться новому товару
+            cur.execute("DELETE FROM shop_products_deleted WHERE id=?", (product_id,))
+        return version
 
-    def shop_seed_demo_if_empty(self) -> None:
-        if self.shop_products_count() > 0:
-            return
+    def _catalog_version_seen(self, version: int) -> None:
+        # Параллельные записи могут закончиться не по порядку: версия только растёт
+        if version > self.catalog_version:
+            self.catalog_version = version
 
-        demo_products = [
-            {
-                "photo_file_id": "",
-                "title_ru": "Kids Hoodie",
-                "title_uz": "Bolalar hudi",
-                "description_ru": "Тёплый и стильный худи для повседневной носки.",
-                "description_uz": "Kundalik kiyish uchun issiq va zamonaviy hudi.",
-                "sizes": "98,104,110,116",
-                "category_slug": "new",
-                "price": 250000,
-                "old_price": 290000,
-                "price_on_request": 0,
-                "stock_qty": 15,
-            },
-            {
-                "photo_file_id": "",
-                "title_ru": "Mini Boss Suit",
-                "title_uz": "Mini Boss kostyum",
-                "description_ru": "Стильный комплект для особых дней.",
-                "description_uz": "Maxsus kunlar uchun zamonaviy to‘plam.",
-                "sizes": "104,110,116,122",
-                "category_slug": "hits",
-                "price": 390000,
-                "old_price": 0,
-                "price_on_request": 0,
-                "stock_qty": 8,
-            },
-            {
-                "photo_file_id": "",
-                "title_ru": "School Set",
-                "title_uz": "Maktab formasi",
-                "description_ru": "Школьная форма премиум качества.",
-                "description_uz": "Premium sifatdagi maktab formasi.",
-                "sizes": "110,116,122,128,134",
-                "category_slug": "school",
-                "price": 320000,
-                "old_price": 350000,
-                "price_on_request": 0,
-                "stock_qty": 20,
-            },
-        ]
 
-        for item in demo_products:
-            self.shop_product_add(**item)
+if DB_PROFILE:
+    profile_methods(Database)
+
+
+# =========================================================
+# ASYNC DATABASE
+# =========================================================
+class AsyncDatabase:
+    """
+    Асинхронный слой над Database.
+
+    Любой метод Database доступен как корутина с той же сигнатурой:
+    `await db.cart_get(user_id)`. Вызов выполняется в ограниченном пуле
+    потоков (DB_POOL_SIZE), у каждого потока своё sqlite-соединение
+    (Database._local), поэтому медленный commit не останавливает
+    polling бота и aiohttp.
+
+    Методы с @db_read (отчёты, выгрузки, админка) идут в отдельный пул
+    DB_READ_POOL_SIZE: тяжёлый отчёт не занимает потоки, нужные оформлению заказов.
+    """
+
+    def __init__(
+        self,
+        database: Database,
+        max_workers: int = DB_POOL_SIZE,
+        read_workers: int = DB_READ_POOL_SIZE,
+    ):
+        self.sync = database
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="db")
+        self._read_executor = ThreadPoolExecutor(max_workers=read_workers, thread_name_prefix="db-read")
+
+    def __getattr__(self, name: str):
+        if name.startswith("_"):
+            raise AttributeError(name)
+
+        method = getattr(self.sync, name)
+        if not callable(method):
+            raise AttributeError(name)
+
+        executor = self._read_executor if getattr(method, "_db_read", False) else self._executor
+
+        @functools.wraps(method)
+        async def call(*args, **kwargs):
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(executor, functools.partial(method, *args, **kwargs))
+
+        # кешируем обёртку, чтобы __getattr__ не вызывался повторно
+        setattr(self, name, call)
+        return call
 
+    def close(self) -> None:
+        self._read_executor.shutdown(wait=True)
+        self._executor.shutdown(wait=True)
+        self.sync.close()
 
-db = Database(DB_PATH)
-db.shop_seed_demo_if_empty()
+
+db = AsyncDatabase(Database(DB_PATH))
 
 
 # =========================================================
@@ -1521,8 +3230,8 @@ def admin_products_list_keyboard(products: List[Dict], action: str) -> InlineKey
 # =========================================================
 # BOT HELPERS
 # =========================================================
-def get_user_lang(user_id: int) -> str:
-    user = db.user_get(user_id)
+async def get_user_lang(user_id: int) -> str:
+    user = await db.user_get(user_id)
     return user_lang_or_default(user)
 
 
@@ -1601,22 +3310,6 @@ def delivery_label(delivery_type: str, lang: str) -> str:
     return ru_map.get(delivery_type, delivery_type)
 
 
-def cart_to_order_items(cart: List[Dict]) -> List[Dict]:
-    items: List[Dict] = []
-    for row in cart:
-        items.append({
-            "cart_id": row.get("id"),
-            "product_id": row.get("product_id"),
-            "product_name": row.get("product_name", ""),
-            "name": row.get("product_name", ""),
-            "price": safe_int(row.get("price"), 0),
-            "qty": safe_int(row.get("qty"), 1),
-            "size": row.get("size", ""),
-            "photo_file_id": row.get("photo_file_id", ""),
-        })
-    return items
-
-
 def format_cart_text(cart: List[Dict], lang: str) -> str:
     title = t(lang, "cart_title")
     if not cart:
@@ -1736,9 +3429,9 @@ def format_my_orders_text(orders: List[Dict], lang: str) -> str:
     return "\n".join(lines).strip()
 
 
-def build_checkout_preview(data: Dict[str, Any], cart: List[Dict], lang: str) -> str:
+async def build_checkout_preview(data: Dict[str, Any], cart: List[Dict], lang: str) -> str:
     items_text = format_order_items(cart_to_order_items(cart), lang)
-    totals = db.cart_totals(data["user_id"])
+    totals = await db.cart_totals(data["user_id"])
     delivery = delivery_label(data.get("delivery_type", ""), lang)
     payment = payment_label(data.get("payment_method", ""), lang)
 
@@ -1833,8 +3526,8 @@ def build_admin_order_text(order: Dict, lang: str = "ru") -> str:
 
 
 async def ensure_user_record(message: Message) -> str:
-    lang = get_user_lang(message.from_user.id)
-    db.user_upsert(
+    lang = await get_user_lang(message.from_user.id)
+    await db.user_upsert(
         user_id=message.from_user.id,
         username=message.from_user.username or "",
         full_name=get_full_name_from_user(message),
@@ -1843,13 +3536,9 @@ async def ensure_user_record(message: Message) -> str:
     return lang
 
 
-async def send_order_to_admins(order_id: int) -> None:
-    order = db.order_get(order_id)
-    if not order:
-        return
-
+async def send_order_to_admins(order: Dict) -> None:
     text = build_admin_order_text(order)
-    kb = order_admin_keyboard(order_id, order.get("user_id"))
+    kb = order_admin_keyboard(order["id"], order.get("user_id"))
 
     for admin_id in ADMIN_IDS:
         try:
@@ -1857,6 +3546,8 @@ async def send_order_to_admins(order_id: int) -> None:
         except Exception as e:
             print(f"Failed to send order to admin {admin_id}: {e}")
 
+    reminders_wakeup.set()
+
 
 async def send_payment_stub(order: Dict, lang: str) -> None:
     """
@@ -1868,7 +3559,7 @@ async def send_payment_stub(order: Dict, lang: str) -> None:
 
     if payment_method == "click":
         fake_url = f"{BASE_URL}/pay/click/{order_id}" if BASE_URL else f"https://t.me/{CHANNEL_USERNAME}"
-        db.order_update_payment(order_id, "pending", payment_provider_url=fake_url)
+        await db.order_update_payment(order_id, "pending", payment_provider_url=fake_url)
         if order.get("user_id"):
             if lang == "uz":
                 text = (
@@ -1887,7 +3578,7 @@ async def send_payment_stub(order: Dict, lang: str) -> None:
 
     elif payment_method == "payme":
         fake_url = f"{BASE_URL}/pay/payme/{order_id}" if BASE_URL else f"https://t.me/{CHANNEL_USERNAME}"
-        db.order_update_payment(order_id, "pending", payment_provider_url=fake_url)
+        await db.order_update_payment(order_id, "pending", payment_provider_url=fake_url)
         if order.get("user_id"):
             if lang == "uz":
                 text = (
@@ -1913,10 +3604,10 @@ async def cmd_start(message: Message, state: FSMContext):
     await state.clear()
 
     user_id = message.from_user.id
-    user = db.user_get(user_id)
+    user = await db.user_get(user_id)
     lang = user_lang_or_default(user)
 
-    db.user_upsert(
+    await db.user_upsert(
         user_id=user_id,
         username=message.from_user.username or "",
         full_name=get_full_name_from_user(message),
@@ -1940,13 +3631,12 @@ async def choose_language(message: Message):
 async def set_language(cb: CallbackQuery):
     lang = "uz" if cb.data == "lang_uz" else "ru"
 
-    db.user_upsert(
+    await db.user_upsert(
         user_id=cb.from_user.id,
         username=cb.from_user.username or "",
         full_name=f"{cb.from_user.first_name or ''} {cb.from_user.last_name or ''}".strip(),
         lang=lang,
     )
-    db.user_set_lang(cb.from_user.id, lang)
 
     text = "✅ Язык изменён." if lang == "ru" else "✅ Til o‘zgartirildi."
     await cb.message.edit_text(text)
@@ -1978,7 +3668,7 @@ async def show_contacts(message: Message):
 @dp.message(F.text.in_(["📦 Мои заказы", "📦 Buyurtmalarim"]))
 async def show_my_orders(message: Message):
     lang = await ensure_user_record(message)
-    orders = db.orders_get_user(message.from_user.id, limit=10)
+    orders = await db.orders_get_user(message.from_user.id, limit=10)
     await message.answer(format_my_orders_text(orders, lang))
 
 
@@ -2033,7 +3723,7 @@ async def size_picker_process(message: Message, state: FSMContext):
 @dp.message(F.text.in_(["🛒 Корзина", "🛒 Savatcha"]))
 async def open_cart(message: Message):
     lang = await ensure_user_record(message)
-    cart = db.cart_get(message.from_user.id)
+    cart = await db.cart_get(message.from_user.id)
 
     if not cart:
         await message.answer(t(lang, "cart_empty"))
@@ -2047,8 +3737,8 @@ async def open_cart(message: Message):
 
 @dp.callback_query(F.data == "cart_clear")
 async def cart_clear_handler(cb: CallbackQuery):
-    lang = get_user_lang(cb.from_user.id)
-    db.cart_clear(cb.from_user.id)
+    lang = await get_user_lang(cb.from_user.id)
+    await db.cart_clear(cb.from_user.id)
 
     if lang == "uz":
         await cb.message.edit_text("🗑 Savatcha tozalandi.")
@@ -2062,8 +3752,8 @@ async def cart_clear_handler(cb: CallbackQuery):
 # =========================================================
 @dp.callback_query(F.data == "checkout_start")
 async def checkout_start(cb: CallbackQuery, state: FSMContext):
-    lang = get_user_lang(cb.from_user.id)
-    cart = db.cart_get(cb.from_user.id)
+    lang = await get_user_lang(cb.from_user.id)
+    cart = await db.cart_get(cb.from_user.id)
 
     if not cart:
         await cb.answer("Корзина пустая" if lang == "ru" else "Savatcha bo‘sh", show_alert=True)
@@ -2116,7 +3806,7 @@ async def checkout_phone(message: Message, state: FSMContext):
 
 @dp.callback_query(OrderStates.waiting_delivery, F.data.startswith("delivery:"))
 async def checkout_delivery(cb: CallbackQuery, state: FSMContext):
-    lang = get_user_lang(cb.from_user.id)
+    lang = await get_user_lang(cb.from_user.id)
     delivery_type = cb.data.split(":", 1)[1]
 
     if delivery_type not in DELIVERY_TYPES:
@@ -2140,7 +3830,7 @@ async def checkout_delivery(cb: CallbackQuery, state: FSMContext):
 
 @dp.callback_query(OrderStates.waiting_address_type, F.data.startswith("addrtype:"))
 async def checkout_address_type(cb: CallbackQuery, state: FSMContext):
-    lang = get_user_lang(cb.from_user.id)
+    lang = await get_user_lang(cb.from_user.id)
     address_type = cb.data.split(":", 1)[1]
 
     await state.update_data(address_type=address_type)
@@ -2269,7 +3959,7 @@ async def checkout_pvz(message: Message, state: FSMContext):
 
 @dp.callback_query(OrderStates.waiting_payment, F.data.startswith("pay:"))
 async def checkout_payment(cb: CallbackQuery, state: FSMContext):
-    lang = get_user_lang(cb.from_user.id)
+    lang = await get_user_lang(cb.from_user.id)
     payment_method = cb.data.split(":", 1)[1]
 
     if payment_method not in PAYMENT_METHODS:
@@ -2292,7 +3982,7 @@ async def checkout_comment(message: Message, state: FSMContext):
     await state.update_data(comment=comment)
 
     data = await state.get_data()
-    cart = db.cart_get(message.from_user.id)
+    cart = await db.cart_get(message.from_user.id)
     if not cart:
         if lang == "uz":
             await message.answer("Savatcha bo‘sh.")
@@ -2301,7 +3991,7 @@ async def checkout_comment(message: Message, state: FSMContext):
         await state.clear()
         return
 
-    preview = build_checkout_preview(data, cart, lang)
+    preview = await build_checkout_preview(data, cart, lang)
     await message.answer(
         preview,
         reply_markup=confirm_order_keyboard(lang),
@@ -2311,7 +4001,7 @@ async def checkout_comment(message: Message, state: FSMContext):
 
 @dp.callback_query(OrderStates.waiting_confirm, F.data == "confirm_order_no")
 async def checkout_cancel(cb: CallbackQuery, state: FSMContext):
-    lang = get_user_lang(cb.from_user.id)
+    lang = await get_user_lang(cb.from_user.id)
     await state.clear()
 
     if lang == "uz":
@@ -2329,26 +4019,13 @@ async def checkout_cancel(cb: CallbackQuery, state: FSMContext):
 @dp.callback_query(OrderStates.waiting_confirm, F.data == "confirm_order_yes")
 async def checkout_confirm(cb: CallbackQuery, state: FSMContext):
     data = await state.get_data()
-    lang = data.get("lang") or get_user_lang(cb.from_user.id)
-
-    cart = db.cart_get(cb.from_user.id)
-    if not cart:
-        await state.clear()
-        await cb.answer("Корзина пуста" if lang == "ru" else "Savatcha bo‘sh", show_alert=True)
-        return
+    lang = data.get("lang") or await get_user_lang(cb.from_user.id)
 
-    items = cart_to_order_items(cart)
-    totals = db.cart_totals(cb.from_user.id)
-
-    order_id = db.order_create({
-        "user_id": cb.from_user.id,
+    order = await db.checkout_from_cart(cb.from_user.id, {
         "username": cb.from_user.username or "",
         "customer_name": data.get("customer_name", ""),
         "customer_phone": data.get("customer_phone", ""),
         "city": data.get("city", ""),
-        "items": items,
-        "total_qty": totals["total_qty"],
-        "total_amount": totals["total_amount"],
         "delivery_service": data.get("delivery_type", ""),
         "delivery_type": data.get("delivery_type", ""),
         "delivery_address": data.get("delivery_address", ""),
@@ -2363,8 +4040,12 @@ async def checkout_confirm(cb: CallbackQuery, state: FSMContext):
         "source": "bot",
     })
 
-    order = db.order_get(order_id)
-    db.cart_clear(cb.from_user.id)
+    if not order:
+        await state.clear()
+        await cb.answer("Корзина пуста" if lang == "ru" else "Savatcha bo‘sh", show_alert=True)
+        return
+
+    order_id = order["id"]
 
     if lang == "uz":
         text = (
@@ -2383,10 +4064,8 @@ async def checkout_confirm(cb: CallbackQuery, state: FSMContext):
         reply_markup=main_menu(lang, cb.from_user.id),
     )
 
-    await send_order_to_admins(order_id)
-
-    if order:
-        await send_payment_stub(order, lang)
+    await send_order_to_admins(order)
+    await send_payment_stub(order, lang)
 
     await state.clear()
     await cb.answer()
@@ -2456,7 +4135,7 @@ async def admin_orders(cb: CallbackQuery):
     if cb.from_user.id not in ADMIN_IDS:
         return
 
-    orders = db.orders_recent()
+    orders = await db.orders_recent()
 
     if not orders:
         await cb.message.answer("Нет заказов")
@@ -2485,7 +4164,7 @@ async def order_status_update(cb: CallbackQuery):
 
     _,order_id,status = cb.data.split(":")
 
-    db.order_update_status(int(order_id),status)
+    await db.order_update_status(int(order_id),status)
 
     await cb.answer("Статус обновлен")
 
@@ -2570,7 +4249,7 @@ async def add_product_description(message:Message,state:FSMContext):
 
     data=await state.get_data()
 
-    db.product_add({
+    await db.product_add({
         "photo_file_id":data["photo"],
         "title_ru":data["title_ru"],
         "title_uz":data["title_uz"],
@@ -2591,7 +4270,7 @@ async def add_product_description(message:Message,state:FSMContext):
 @dp.callback_query(F.data=="list_products")
 async def list_products(cb:CallbackQuery):
 
-    products=db.products_all()
+    products=await db.products_all()
 
     if not products:
 
@@ -2613,7 +4292,7 @@ async def delete_product(cb:CallbackQuery):
 
     _,pid=cb.data.split(":")
 
-    db.product_delete(int(pid))
+    await db.product_delete(int(pid))
 
     await cb.answer("Товар удален")
 
@@ -2624,7 +4303,7 @@ async def delete_product(cb:CallbackQuery):
 @dp.callback_query(F.data=="admin_stats")
 async def admin_stats(cb:CallbackQuery):
 
-    stats=db.stats()
+    stats=await db.stats()
 
     text=(
         f"📊 Статистика\n\n"
@@ -2762,7 +4441,7 @@ async def admin_panel_open(message: Message):
     if not admin_only(message.from_user.id):
         return
 
-    lang = get_user_lang(message.from_user.id)
+    lang = await get_user_lang(message.from_user.id)
     text = admin_text(lang, "🛠 Админ панель", "🛠 Admin panel")
     await message.answer(text, reply_markup=admin_panel_keyboard(lang))
 
@@ -2776,14 +4455,14 @@ async def admin_orders_new(cb: CallbackQuery):
         await cb.answer()
         return
 
-    orders = db.orders_get_by_status("new", limit=20)
+    orders = await db.orders_get_by_status("new", limit=20)
     if not orders:
         await cb.message.answer("Новых заказов нет.")
         await cb.answer()
         return
 
     for order in orders:
-        db.order_mark_seen(order["id"], cb.from_user.id)
+        await db.order_mark_seen(order["id"], cb.from_user.id)
         await cb.message.answer(
             build_admin_order_text(order),
             reply_markup=order_admin_keyboard(order["id"], order.get("user_id")),
@@ -2792,19 +4471,37 @@ async def admin_orders_new(cb: CallbackQuery):
     await cb.answer()
 
 
-@dp.callback_query(F.data == "admin_orders_all")
+def admin_orders_pager_keyboard(page: Dict[str, Any]) -> Optional[InlineKeyboardMarkup]:
+    buttons: List[InlineKeyboardButton] = []
+    if page.get("prev_cursor"):
+        buttons.append(InlineKeyboardButton(text="⬅️ Новее", callback_data=f"admin_orders_all:{page['prev_cursor']}"))
+    if page.get("next_cursor"):
+        buttons.append(InlineKeyboardButton(text="Старее ➡️", callback_data=f"admin_orders_all:{page['next_cursor']}"))
+    return InlineKeyboardMarkup(inline_keyboard=[buttons]) if buttons else None
+
+
+@dp.callback_query(F.data.startswith("admin_orders_all"))
 async def admin_orders_all(cb: CallbackQuery):
     if not admin_only(cb.from_user.id):
         await cb.answer()
         return
 
-    orders = db.orders_filter(limit=30)
-    if not orders:
+    cursor = cb.data.split(":", 1)[1] if ":" in cb.data else ""
+    page = await db.orders_filter(page_size=30, cursor=cursor)
+    if not page["rows"] and not cursor:
         await cb.message.answer("Заказов пока нет.")
         await cb.answer()
         return
 
-    await cb.message.answer("📋 Последние заказы:\n\n" + format_orders_short_list(orders))
+    text = "📋 Заказы:\n\n" + format_orders_short_list(page["rows"])
+    kb = admin_orders_pager_keyboard(page)
+    if cursor:
+        try:
+            await cb.message.edit_text(text, reply_markup=kb)
+        except Exception:
+            await cb.message.answer(text, reply_markup=kb)
+    else:
+        await cb.message.answer(text, reply_markup=kb)
     await cb.answer()
 
 
@@ -2815,11 +4512,11 @@ async def admin_find_orders(message: Message):
 
     parts = (message.text or "").split(maxsplit=1)
     if len(parts) < 2:
-        await message.answer("Использование: /find 90 или /find 901234")
+        await message.answer("Использование: /find 901234, /find Иван или /find Самарканд")
         return
 
-    phone_part = parts[1].strip()
-    rows = db.find_orders_by_phone(phone_part, limit=20)
+    # Телефон, имя, город, адрес или комментарий: полнотекстовый поиск по orders_fts
+    rows = await db.orders_search(parts[1].strip(), limit=20)
     if not rows:
         await message.answer("Ничего не найдено.")
         return
@@ -2848,13 +4545,13 @@ async def order_status_update(cb: CallbackQuery):
         await cb.answer("Неверный статус")
         return
 
-    db.order_update_status(order_id, new_status, manager_id=cb.from_user.id)
-    order = db.order_get(order_id)
+    await db.order_update_status(order_id, new_status, manager_id=cb.from_user.id)
+    order = await db.order_get(order_id)
 
     await cb.answer("Статус обновлён")
 
     if order and order.get("user_id"):
-        user_lang = get_user_lang(order["user_id"])
+        user_lang = await get_user_lang(order["user_id"])
         if user_lang == "uz":
             text = f"📦 Buyurtmangiz №{order_id} holati yangilandi: <b>{status_label(new_status, 'uz')}</b>"
         else:
@@ -2892,7 +4589,7 @@ async def admin_edit_product_menu(cb: CallbackQuery):
         await cb.answer()
         return
 
-    products = db.shop_products_list(published_only=False, limit=50)
+    products = await db.shop_products_list(published_only=False, limit=50)
     if not products:
         await cb.message.answer("Товаров пока нет.")
         await cb.answer()
@@ -2911,7 +4608,7 @@ async def admin_delete_product_menu(cb: CallbackQuery):
         await cb.answer()
         return
 
-    products = db.shop_products_list(published_only=False, limit=50)
+    products = await db.shop_products_list(published_only=False, limit=50)
     if not products:
         await cb.message.answer("Товаров пока нет.")
         await cb.answer()
@@ -3038,7 +4735,7 @@ async def add_product_publish(message: Message, state: FSMContext):
 
     data = await state.get_data()
 
-    product_id = db.shop_product_add(
+    product_id = await db.shop_product_add(
         photo_file_id=data.get("photo_file_id", ""),
         title_ru=data.get("title_ru", ""),
         title_uz=data.get("title_uz", ""),
@@ -3054,7 +4751,7 @@ async def add_product_publish(message: Message, state: FSMContext):
         sort_order=0,
     )
 
-    product = db.shop_product_get(product_id)
+    product = await db.shop_product_get(product_id)
     await state.clear()
 
     await message.answer("✅ Товар добавлен.")
@@ -3094,7 +4791,7 @@ async def admin_edit_pick(cb: CallbackQuery):
         await cb.answer("Ошибка")
         return
 
-    product = db.shop_product_get(product_id)
+    product = await db.shop_product_get(product_id)
     if not product:
         await cb.message.answer("Товар не найден.")
         await cb.answer()
@@ -3155,8 +4852,8 @@ async def admin_edit_new_photo(message: Message, state: FSMContext):
         return
 
     new_value = message.photo[-1].file_id
-    db.shop_product_update_field(product_id, "photo_file_id", new_value)
-    product = db.shop_product_get(product_id)
+    await db.shop_product_update_field(product_id, "photo_file_id", new_value)
+    product = await db.shop_product_get(product_id)
     await state.clear()
 
     await message.answer("✅ Фото обновлено.")
@@ -3190,8 +4887,8 @@ async def admin_edit_new_value(message: Message, state: FSMContext):
     else:
         value = raw_value
 
-    db.shop_product_update_field(product_id, field_name, value)
-    product = db.shop_product_get(product_id)
+    await db.shop_product_update_field(product_id, field_name, value)
+    product = await db.shop_product_get(product_id)
     await state.clear()
 
     await message.answer("✅ Поле обновлено.")
@@ -3217,7 +4914,7 @@ async def admin_delete_product(cb: CallbackQuery):
         await cb.answer("Ошибка")
         return
 
-    db.shop_product_delete(product_id)
+    await db.shop_product_delete(product_id)
     await cb.message.answer(f"🗑 Товар ID {product_id} удалён.")
     await cb.answer("Удалено")
 
@@ -3236,54 +4933,148 @@ async def admin_publish_product(cb: CallbackQuery):
         await cb.answer("Ошибка")
         return
 
-    db.shop_product_update_publish(product_id, publish_value)
-    product = db.shop_product_get(product_id)
-    if not product:
-        await cb.answer("Товар не найден")
+    await db.shop_product_update_publish(product_id, publish_value)
+    product = await db.shop_product_get(product_id)
+    if not product:
+        await cb.answer("Товар не найден")
+        return
+
+    text = "✅ Статус публикации обновлён.\n\n" + product_card_text(product, "ru")
+    await cb.message.answer(
+        text,
+        reply_markup=admin_product_actions_keyboard(product_id, safe_int(product.get("is_published"), 1)),
+    )
+    await cb.answer("Готово")
+
+
+# =========================================================
+# ADMIN STATS
+# =========================================================
+@dp.callback_query(F.data == "admin_stats")
+async def admin_stats(cb: CallbackQuery):
+    if not admin_only(cb.from_user.id):
+        await cb.answer()
+        return
+
+    stats = await db.get_stats_all()
+    products_count = await db.shop_products_count()
+
+    text = (
+        "📊 <b>Статистика</b>\n\n"
+        f"Всего заказов: <b>{safe_int(stats.get('total'), 0)}</b>\n"
+        f"Новые: <b>{safe_int(stats.get('new_count'), 0)}</b>\n"
+        f"В обработке: <b>{safe_int(stats.get('processing'), 0)}</b>\n"
+        f"Подтверждены: <b>{safe_int(stats.get('confirmed'), 0)}</b>\n"
+        f"Оплачены: <b>{safe_int(stats.get('paid_count'), 0)}</b>\n"
+        f"Отправлены: <b>{safe_int(stats.get('shipped'), 0)}</b>\n"
+        f"Доставлены: <b>{safe_int(stats.get('delivered'), 0)}</b>\n"
+        f"Отменены: <b>{safe_int(stats.get('cancelled'), 0)}</b>\n"
+        f"Уникальных клиентов: <b>{safe_int(stats.get('unique_users'), 0)}</b>\n"
+        f"Товаров в базе: <b>{products_count}</b>"
+    )
+    await cb.message.answer(text)
+    await cb.answer()
+
+
+@dp.message(Command("stats_rebuild"))
+async def admin_stats_rebuild(message: Message):
+    if not admin_only(message.from_user.id):
+        return
+
+    drift = await db.stats_counters_rebuild()
+    if not drift:
+        await message.answer("✅ Счётчики статистики сходятся с таблицей заказов.")
+        return
+
+    lines = [f"{esc(k)}: {v:+d}" for k, v in drift.items()]
+    await message.answer("🛠 Счётчики пересчитаны. Расхождение (было − стало):\n\n" + "\n".join(lines))
+
+
+@dp.message(Command("backup"))
+async def admin_backup(message: Message):
+    if not admin_only(message.from_user.id):
+        return
+
+    if backup_lock.locked():
+        await message.answer("⏳ Бэкап уже выполняется.")
+        return
+
+    await message.answer("💾 Делаю бэкап базы...")
+    try:
+        result = await run_backup()
+    except Exception as e:
+        await message.answer(f"❌ Бэкап не удался: {esc(str(e))}")
+        return
+
+    await message.answer(
+        "✅ Бэкап готов\n\n"
+        f"Файл: <code>{esc(result['path'])}</code>\n"
+        f"Размер: {result['size'] / 1024 / 1024:.1f} МБ\n"
+        f"Время: {result['seconds']} с\n"
+        f"Хранится снимков: {result['kept']}"
+    )
+
+
+@dp.message(Command("db_profile"))
+async def admin_db_profile(message: Message):
+    if not admin_only(message.from_user.id):
+        return
+
+    if not DB_PROFILE:
+        await message.answer("Профилировщик выключен. Включается переменной DB_PROFILE=1.")
+        return
+
+    if (message.text or "").split()[1:2] == ["reset"]:
+        db_profiler.reset()
+        await message.answer("✅ Статистика профилировщика сброшена.")
         return
 
-    text = "✅ Статус публикации обновлён.\n\n" + product_card_text(product, "ru")
-    await cb.message.answer(
-        text,
-        reply_markup=admin_product_actions_keyboard(product_id, safe_int(product.get("is_published"), 1)),
-    )
-    await cb.answer("Готово")
+    report = db_profiler.report(limit=10)
+    lines = [f"📊 <b>Профиль БД</b> с {esc(report['since'])}\n"]
+    for m in report["methods"]:
+        lines.append(
+            f"<code>{esc(m['method'])}</code> ×{m['calls']}: "
+            f"всего {m['total_ms']} мс, p50 {m['p50_ms']} / p95 {m['p95_ms']} / p99 {m['p99_ms']} мс, "
+            f"~{m['avg_rows']} строк"
+        )
+    if report["slow"]:
+        lines.append(f"\n🐢 <b>Медленные SQL</b> (> {report['slow_ms']:g} мс):")
+        for q in report["slow"][:5]:
+            lines.append(f"{q['ms']} мс — <code>{esc(q['sql'][:200])}</code>")
+            if q["plan"]:
+                lines.append("  " + esc(" / ".join(q["plan"])))
+    await message.answer("\n".join(lines)[:4000])
 
 
-# =========================================================
-# ADMIN STATS
-# =========================================================
-@dp.callback_query(F.data == "admin_stats")
-async def admin_stats(cb: CallbackQuery):
-    if not admin_only(cb.from_user.id):
-        await cb.answer()
+@dp.message(Command("rollups_rebuild"))
+async def admin_rollups_rebuild(message: Message):
+    if not admin_only(message.from_user.id):
         return
 
-    stats = db.get_stats_all()
-    products_count = db.shop_products_count()
+    await message.answer("Пересобираю дневную статистику...")
+    await db.rollups_rebuild()
+    await message.answer("✅ Готово.")
 
-    text = (
-        "📊 <b>Статистика</b>\n\n"
-        f"Всего заказов: <b>{safe_int(stats.get('total'), 0)}</b>\n"
-        f"Новые: <b>{safe_int(stats.get('new_count'), 0)}</b>\n"
-        f"В обработке: <b>{safe_int(stats.get('processing'), 0)}</b>\n"
-        f"Подтверждены: <b>{safe_int(stats.get('confirmed'), 0)}</b>\n"
-        f"Оплачены: <b>{safe_int(stats.get('paid_count'), 0)}</b>\n"
-        f"Отправлены: <b>{safe_int(stats.get('shipped'), 0)}</b>\n"
-        f"Доставлены: <b>{safe_int(stats.get('delivered'), 0)}</b>\n"
-        f"Отменены: <b>{safe_int(stats.get('cancelled'), 0)}</b>\n"
-        f"Уникальных клиентов: <b>{safe_int(stats.get('unique_users'), 0)}</b>\n"
-        f"Товаров в базе: <b>{products_count}</b>"
-    )
-    await cb.message.answer(text)
-    await cb.answer()
+
+@dp.message(Command("vacuum_convert"))
+async def admin_vacuum_convert(message: Message):
+    if not admin_only(message.from_user.id):
+        return
+
+    await message.answer("Перевожу базу на incremental vacuum (полный VACUUM, запись на это время встанет)...")
+    started = time.perf_counter()
+    converted = await db.db_vacuum_convert()
+    if not converted:
+        await message.answer("База уже на auto_vacuum=INCREMENTAL.")
+        return
+    await message.answer(f"✅ Готово за {time.perf_counter() - started:.1f} с.")
 
 
 # =========================================================
 # REMINDERS
 # =========================================================
 async def check_reminders():
-    orders = db.orders_get_for_reminder()
+    orders = await db.orders_get_for_reminder()
     if not orders:
         return
 
@@ -3302,23 +5093,118 @@ async def check_reminders():
         except Exception as e:
             print(f"Reminder failed for {admin_id}: {e}")
 
-    for o in orders:
-        db.order_update_reminded(o["id"])
+    await db.orders_mark_reminded([o["id"] for o in orders])
+
+
+# Будит reminders_loop, когда появляется новый заказ
+reminders_wakeup = asyncio.Event()
 
 
 async def reminders_loop():
+    """
+    Спит ровно до момента, когда ближайший заказ перейдёт порог REMINDER_AFTER.
+    Если ждать нечего — спит до следующего нового заказа.
+    """
     while True:
+        # Сбрасываем до проверки, чтобы не потерять заказ, созданный во время неё
+        reminders_wakeup.clear()
+        delay: Optional[float] = None
         try:
             await check_reminders()
+            next_at = await db.orders_next_reminder_at()
+            if next_at:
+                delay = max(1.0, (next_at - now_tz()).total_seconds())
         except Exception as e:
             print("reminders_loop error:", e)
-        await asyncio.sleep(30 * 60)
+            delay = 60.0
+        try:
+            await asyncio.wait_for(reminders_wakeup.wait(), timeout=delay)
+        except asyncio.TimeoutError:
+            pass
+
+
+# =========================================================
+# EVENTS FLUSH / RETENTION
+# =========================================================
+async def events_flush_loop():
+    while True:
+        await asyncio.sleep(EVENTS_FLUSH_SECONDS)
+        try:
+            await db.events_flush()
+        except Exception as e:
+            print("events_flush_loop error:", e)
+
+
+async def events_retention_loop():
+    """Раз в сутки: архивирование старых событий и incremental vacuum."""
+    while True:
+        try:
+            result = await db.events_retention(EVENTS_RETENTION_DAYS)
+            if result["archived"]:
+                print(
+                    f"🗄 События: в архив {result['archived']}, "
+                    f"освобождено страниц {result['freed_pages']}"
+                )
+        except Exception as e:
+            print("events_retention_loop error:", e)
+        await asyncio.sleep(24 * 60 * 60)
+
+
+# =========================================================
+# ABANDONED CARTS
+# =========================================================
+async def carts_expire_loop():
+    """Каждые 6 часов удаляет корзины старше CART_TTL_DAYS."""
+    while True:
+        try:
+            result = await db.carts_expire(CART_TTL_DAYS)
+            if result["carts"]:
+                print(f"🛒 Брошенные корзины: удалено {result['carts']} ({result['rows']} строк)")
+        except Exception as e:
+            print("carts_expire_loop error:", e)
+        await asyncio.sleep(6 * 60 * 60)
+
+
+# =========================================================
+# BACKUP
+# =========================================================
+backup_lock = asyncio.Lock()
+
+
+async def run_backup() -> Dict[str, Any]:
+    """
+    Бэкап идёт в отдельном потоке (asyncio.to_thread), а не в пуле БД:
+    копирование большой базы не занимает слоты, нужные хендлерам.
+    """
+    async with backup_lock:
+        # Запись только через пул БД: поток бэкапа открывает одно читающее соединение
+        await db.events_flush()
+        result = await asyncio.to_thread(db.sync.backup_create, BACKUP_DIR, BACKUP_KEEP)
+    print(f"💾 Бэкап: {result['path']} ({result['size']} байт, {result['seconds']} с)")
+    return result
+
+
+async def backup_loop():
+    """Бэкап раз в BACKUP_INTERVAL_HOURS, считая от последнего снимка — переживает рестарты."""
+    interval = BACKUP_INTERVAL_HOURS * 60 * 60
+    while True:
+        snapshots = list(Path(BACKUP_DIR).glob(f"{Path(DB_PATH).stem}_*.db.gz"))
+        last = max((p.stat().st_mtime for p in snapshots), default=0.0)
+        wait = last + interval - time.time()
+        if wait > 0:
+            await asyncio.sleep(wait)
+            continue
+        try:
+            await run_backup()
+        except Exception as e:
+            print("backup_loop error:", e)
+            await asyncio.sleep(60 * 60)
 
 
 # =========================================================
 # EXCEL REPORTS
 # =========================================================
-def build_excel_report(filename: str, orders: List[Dict]) -> int:
+def build_excel_report(filename: str, orders: List[Dict], items_map: Dict[int, List[Dict]]) -> int:
     wb = Workbook()
     ws = wb.active
     ws.title = "Orders"
@@ -3336,14 +5222,9 @@ def build_excel_report(filename: str, orders: List[Dict]) -> int:
     total_amount = 0
 
     for o in orders:
-        try:
-            items = json.loads(o.get("items") or "[]")
-        except Exception:
-            items = []
-
         items_text = ", ".join([
-            f"{(it.get('product_name') or it.get('name') or 'item')} x{it.get('qty', 1)}"
-            for it in items
+            f"{it.get('product_name') or 'item'} x{it.get('qty', 1)}"
+            for it in items_map.get(o["id"], [])
         ])
 
         order_sum = safe_int(o.get("total_amount"), 0)
@@ -3370,16 +5251,17 @@ def build_excel_report(filename: str, orders: List[Dict]) -> int:
 async def generate_monthly_report_to_admins():
     year, month = prev_month(now_tz())
 
-    if db.report_is_sent(year, month):
+    if await db.report_is_sent(year, month):
         return
 
-    orders = db.orders_get_monthly(year, month)
+    orders = await db.orders_get_monthly(year, month)
     if not orders:
         return
 
     Path("reports").mkdir(exist_ok=True)
     filename = f"reports/report_{year}_{month:02d}.xlsx"
-    total_amount = build_excel_report(filename, orders)
+    items_map = await db.order_items_by_orders([o["id"] for o in orders])
+    total_amount = build_excel_report(filename, orders, items_map)
 
     for admin_id in ADMIN_IDS:
         try:
@@ -3393,7 +5275,7 @@ async def generate_monthly_report_to_admins():
         except Exception as e:
             print(f"Failed to send report to {admin_id}: {e}")
 
-    db.report_mark_sent(year, month, filename, len(orders), total_amount)
+    await db.report_mark_sent(year, month, filename, len(orders), total_amount)
 
 
 # =========================================================
@@ -3414,8 +5296,8 @@ async def cron_post_daily_to_channel():
                 pass
         return
 
-    week_key = db.week_key_now(now)
-    post = db.sched_get_for_day(dow, week_key)
+    week_key = db.sync.week_key_now(now)
+    post = await db.sched_get_for_day(dow, week_key)
     if not post:
         return
 
@@ -3431,7 +5313,7 @@ async def cron_post_daily_to_channel():
         else:
             await bot.send_message(CHANNEL_ID, caption)
 
-        db.sched_mark_posted(post["id"])
+        await db.sched_mark_posted(post["id"])
     except Exception as e:
         print("Post error:", e)
 
@@ -3472,6 +5354,29 @@ def parse_web_lang(request: web.Request) -> str:
     return "uz" if lang == "uz" else "ru"
 
 
+def etag_matches(request: web.Request, etag: str) -> bool:
+    header = request.headers.get("If-None-Match", "")
+    if not header:
+        return False
+    tags = [tag.strip().removeprefix("W/") for tag in header.split(",")]
+    return "*" in tags or etag in tags
+
+
+def accepts_gzip(request: web.Request) -> bool:
+    for part in request.headers.get("Accept-Encoding", "").lower().split(","):
+        coding, _, params = part.partition(";")
+        if coding.strip() == "gzip":
+            return params.replace(" ", "") not in ("q=0", "q=0.0", "q=0.00", "q=0.000")
+    return False
+
+
+# Поля товара в ответе каталога по умолчанию: только текущий язык, без служебных
+PRODUCT_WEB_FIELDS = (
+    "id", "title", "description", "sizes", "category_slug",
+    "price", "old_price", "price_on_request", "stock_qty", "photo",
+)
+
+
 def product_to_web_dict(product: Dict, lang: str) -> Dict[str, Any]:
     return {
         "id": product.get("id"),
@@ -3483,6 +5388,7 @@ def product_to_web_dict(product: Dict, lang: str) -> Dict[str, Any]:
         "description_uz": product.get("description_uz"),
         "sizes": parse_sizes_text(product.get("sizes") or ""),
         "sizes_text": product.get("sizes") or "",
+        "sort_order": safe_int(product.get("sort_order"), 0),
         "category_slug": product.get("category_slug") or "casual",
         "price": safe_int(product.get("price"), 0),
         "old_price": safe_int(product.get("old_price"), 0),
@@ -3493,17 +5399,12 @@ def product_to_web_dict(product: Dict, lang: str) -> Dict[str, Any]:
     }
 
 
-def admin_orders_html_rows(rows: List[Dict]) -> str:
+def admin_orders_html_rows(rows: List[Dict], items_map: Dict[int, List[Dict]]) -> str:
     html_rows = []
     for o in rows:
-        try:
-            items = json.loads(o.get("items") or "[]")
-        except Exception:
-            items = []
-
         items_preview = ", ".join([
-            f"{esc((it.get('product_name') or it.get('name') or 'item'))} x{safe_int(it.get('qty'), 1)}"
-            for it in items[:3]
+            f"{esc(it.get('product_name') or 'item')} x{safe_int(it.get('qty'), 1)}"
+            for it in items_map.get(o["id"], [])[:3]
         ])
 
         html_rows.append(
@@ -3540,81 +5441,117 @@ def admin_products_html_rows(rows: List[Dict]) -> str:
     return "\n".join(html_rows)
 
 
-# =========================================================
-# WEB PAGES
-# =========================================================
-async def shop_index(request: web.Request) -> web.Response:
-    lang = parse_web_lang(request)
-    is_uz = lang == "uz"
-
-    title = "ZARY SHOP" if not is_uz else "ZARY DO'KON"
-    shop_label = "Магазин" if not is_uz else "Do'kon"
-    cart_label = "Корзина" if not is_uz else "Savatcha"
-    order_label = "Оформить заказ" if not is_uz else "Buyurtma berish"
-    empty_cart_label = "Корзина пуста" if not is_uz else "Savatcha bo'sh"
-    name_label = "Имя" if not is_uz else "Ism"
-    phone_label = "Телефон" if not is_uz else "Telefon"
-    city_label = "Город" if not is_uz else "Shahar"
-    address_label = "Адрес" if not is_uz else "Manzil"
-    comment_label = "Комментарий" if not is_uz else "Izoh"
-    delivery_label_title = "Доставка" if not is_uz else "Yetkazish"
-    payment_label_title = "Оплата" if not is_uz else "To'lov"
-    success_label = "Заказ отправлен" if not is_uz else "Buyurtma yuborildi"
-    sizes_label = "Размеры" if not is_uz else "Razmerlar"
-    total_label = "Итого" if not is_uz else "Jami"
-    add_to_cart_label = "В корзину" if not is_uz else "Savatchaga"
-    old_price_label = "Старая цена" if not is_uz else "Eski narx"
-    stock_label = "Остаток" if not is_uz else "Qoldiq"
-    delivery_1 = "Яндекс курьер" if not is_uz else "Yandex kuryer"
-    delivery_2 = "B2B почта" if not is_uz else "B2B pochta"
-    delivery_3 = "Яндекс ПВЗ" if not is_uz else "Yandex PVZ"
+# Подписи витрины по языкам: отдаются отдельным скриптом, HTML и JS от языка не зависят
+SHOP_LABELS: Dict[str, Dict[str, str]] = {
+    "ru": {
+        "title": "ZARY SHOP",
+        "shop": "Магазин",
+        "cart": "Корзина",
+        "order": "Оформить заказ",
+        "empty_cart": "Корзина пуста",
+        "name": "Имя",
+        "phone": "Телефон",
+        "city": "Город",
+        "address": "Адрес",
+        "comment": "Комментарий",
+        "delivery": "Доставка",
+        "payment": "Оплата",
+        "success": "Заказ отправлен",
+        "sizes": "Размеры",
+        "total": "Итого",
+        "add_to_cart": "В корзину",
+        "old_price": "Старая цена",
+        "stock": "Остаток",
+        "delivery_1": "Яндекс курьер",
+        "delivery_2": "B2B почта",
+        "delivery_3": "Яндекс ПВЗ",
+    },
+    "uz": {
+        "title": "ZARY DO'KON",
+        "shop": "Do'kon",
+        "cart": "Savatcha",
+        "order": "Buyurtma berish",
+        "empty_cart": "Savatcha bo'sh",
+        "name": "Ism",
+        "phone": "Telefon",
+        "city": "Shahar",
+        "address": "Manzil",
+        "comment": "Izoh",
+        "delivery": "Yetkazish",
+        "payment": "To'lov",
+        "success": "Buyurtma yuborildi",
+        "sizes": "Razmerlar",
+        "total": "Jami",
+        "add_to_cart": "Savatchaga",
+        "old_price": "Eski narx",
+        "stock": "Qoldiq",
+        "delivery_1": "Yandex kuryer",
+        "delivery_2": "B2B pochta",
+        "delivery_3": "Yandex PVZ",
+    },
+}
 
-    html_page = f"""
-<!DOCTYPE html>
-<html lang="{lang}">
-<head>
-<meta charset="utf-8"/>
-<meta name="viewport" content="width=device-width, initial-scale=1"/>
-<title>{title}</title>
-<style>
-*{{box-sizing:border-box}}
-body{{margin:0;font-family:Arial,sans-serif;background:#f6f6f6;color:#111}}
-header{{background:#111;color:#fff;padding:18px 16px;position:sticky;top:0;z-index:9}}
-.wrap{{max-width:1180px;margin:0 auto;padding:18px}}
-.topbar{{display:flex;justify-content:space-between;align-items:center;gap:12px;flex-wrap:wrap}}
-.brand{{font-size:24px;font-weight:700;letter-spacing:.5px}}
-.langs a{{color:#fff;text-decoration:none;margin-left:10px;padding:6px 10px;border:1px solid rgba(255,255,255,.2);border-radius:8px}}
-.layout{{display:grid;grid-template-columns:1fr 360px;gap:18px}}
-.grid{{display:grid;grid-template-columns:repeat(auto-fill,minmax(230px,1fr));gap:16px}}
-.card{{background:#fff;border-radius:16px;overflow:hidden;box-shadow:0 6px 18px rgba(0,0,0,.06)}}
-.card img{{width:100%;height:250px;object-fit:cover;background:#ececec}}
-.card .ph{{width:100%;height:250px;background:#ececec;display:flex;align-items:center;justify-content:center;color:#777}}
-.card-body{{padding:14px}}
-.card h3{{margin:0 0 8px;font-size:18px}}
-.muted{{color:#666;font-size:14px}}
-.price{{font-size:20px;font-weight:700;margin:10px 0 4px}}
-.old{{text-decoration:line-through;color:#999;font-size:14px}}
-.sizes{{font-size:13px;color:#555;margin:8px 0}}
-.stock{{font-size:13px;color:#555;margin:8px 0}}
-.btn{{display:inline-block;width:100%;padding:11px 12px;border:none;border-radius:10px;background:#111;color:#fff;cursor:pointer;font-size:15px}}
-.btn.secondary{{background:#e9e9e9;color:#111}}
-.side{{background:#fff;border-radius:16px;padding:16px;box-shadow:0 6px 18px rgba(0,0,0,.06);position:sticky;top:90px;height:max-content}}
-.field{{margin-bottom:10px}}
-.field label{{display:block;font-size:13px;margin-bottom:6px;color:#555}}
-.field input,.field select,.field textarea{{width:100%;padding:10px;border:1px solid #ddd;border-radius:10px;font-size:14px}}
-.cart-list{{max-height:240px;overflow:auto;margin-bottom:14px}}
-.cart-item{{padding:10px 0;border-bottom:1px solid #eee;font-size:14px}}
-.row{{display:flex;justify-content:space-between;gap:8px}}
-.badge{{display:inline-block;padding:4px 8px;border-radius:999px;background:#f1f1f1;font-size:12px;margin-right:6px;margin-bottom:6px}}
-.notice{{padding:10px 12px;border-radius:10px;background:#f8f3d8;color:#6a5800;font-size:13px;margin-bottom:12px}}
-.footer{{padding:30px 0 10px;color:#777;font-size:13px}}
-@media (max-width: 920px) {{
-  .layout{{grid-template-columns:1fr}}
-  .side{{position:static}}
-}}
-</style>
-</head>
-<body>
+SHOP_CSS = """
+*{box-sizing:border-box}
+body{margin:0;font-family:Arial,sans-serif;background:#f6f6f6;color:#111}
+header{background:#111;color:#fff;padding:18px 16px;position:sticky;top:0;z-index:9}
+.wrap{max-width:1180px;margin:0 auto;padding:18px}
+.topbar{display:flex;justify-content:space-between;align-items:center;gap:12px;flex-wrap:wrap}
+.brand{font-size:24px;font-weight:700;letter-spacing:.5px}
+.langs a{color:#fff;text-decoration:none;margin-left:10px;padding:6px 10px;border:1px solid rgba(255,255,255,.2);border-radius:8px}
+.layout{display:grid;grid-template-columns:1fr 360px;gap:18px}
+.grid{display:grid;grid-template-columns:repeat(auto-fill,minmax(230px,1fr));gap:16px}
+.card{background:#fff;border-radius:16px;overflow:hidden;box-shadow:0 6px 18px rgba(0,0,0,.06)}
+.card img{width:100%;height:250px;object-fit:cover;background:#ececec}
+.card .ph{width:100%;height:250px;background:#ececec;display:flex;align-items:center;justify-content:center;color:#777}
+.card-body{padding:14px}
+.card h3{margin:0 0 8px;font-size:18px}
+.muted{color:#666;font-size:14px}
+.price{font-size:20px;font-weight:700;margin:10px 0 4px}
+.old{text-decoration:line-through;color:#999;font-size:14px}
+.sizes{font-size:13px;color:#555;margin:8px 0}
+.stock{font-size:13px;color:#555;margin:8px 0}
+.btn{display:inline-block;width:100%;padding:11px 12px;border:none;border-radius:10px;background:#111;color:#fff;cursor:pointer;font-size:15px}
+.btn.secondary{background:#e9e9e9;color:#111}
+.side{background:#fff;border-radius:16px;padding:16px;box-shadow:0 6px 18px rgba(0,0,0,.06);position:sticky;top:90px;height:max-content}
+.field{margin-bottom:10px}
+.field label{display:block;font-size:13px;margin-bottom:6px;color:#555}
+.field input,.field select,.field textarea{width:100%;padding:10px;border:1px solid #ddd;border-radius:10px;font-size:14px}
+.cart-list{max-height:240px;overflow:auto;margin-bottom:14px}
+.cart-item{padding:10px 0;border-bottom:1px solid #eee;font-size:14px}
+.row{display:flex;justify-content:space-between;gap:8px}
+.badge{display:inline-block;padding:4px 8px;border-radius:999px;background:#f1f1f1;font-size:12px;margin-right:6px;margin-bottom:6px}
+.notice{padding:10px 12px;border-radius:10px;background:#f8f3d8;color:#6a5800;font-size:13px;margin-bottom:12px}
+.footer{padding:30px 0 10px;color:#777;font-size:13px}
+@media (max-width: 920px) {
+  .layout{grid-template-columns:1fr}
+  .side{position:static}
+}
+"""
+
+# Разметку витрины рисует скрипт: подписи приходят из SHOP_LABELS, язык берётся из <html lang>
+SHOP_JS = """
+const LANG = document.documentElement.lang || "ru";
+const L = window.SHOP_LABELS || {};
+const PAGE_SIZE = 24;
+// sort_order нужен, чтобы упорядочить локальную копию так же, как сервер
+const FIELDS = "id,title,description,sizes,category_slug,price,old_price,price_on_request,stock_qty,photo,sort_order";
+let PRODUCTS = [];
+let NEXT_CURSOR = null;
+let LOADING = false;
+let MORE_OBSERVER = null;
+let SUBMITTING = false;
+// Локальная копия каталога в IndexedDB и версия, до которой она досинхронизирована
+let STORE = null;
+let CATALOG_VERSION = 0;
+let CART = JSON.parse(localStorage.getItem("zary_cart") || "[]");
+
+function field(id, label, input) {
+  return `<div class="field"><label>${label}</label>${input || `<input id="${id}" />`}</div>`;
+}
+
+function renderLayout() {
+  document.getElementById("app").innerHTML = `
 <header>
   <div class="wrap topbar">
     <div class="brand">ZARY & CO</div>
@@ -3628,20 +5565,21 @@ header{{background:#111;color:#fff;padding:18px 16px;position:sticky;top:0;z-ind
 <div class="wrap">
   <div class="layout">
     <section>
-      <h2 style="margin:0 0 14px">{shop_label}</h2>
+      <h2 style="margin:0 0 14px">${L.shop}</h2>
       <div id="products" class="grid"></div>
+      <div id="more"></div>
       <div class="footer">
-        Telegram: {FOLLOW_TG}<br/>
-        Instagram: {FOLLOW_IG}<br/>
-        YouTube: {FOLLOW_YT}
+        Telegram: ${L.follow_tg}<br/>
+        Instagram: ${L.follow_ig}<br/>
+        YouTube: ${L.follow_yt}
       </div>
     </section>
 
     <aside class="side">
-      <h3 style="margin-top:0">{cart_label}</h3>
+      <h3 style="margin-top:0">${L.cart}</h3>
       <div id="cartList" class="cart-list"></div>
       <div class="row" style="margin:12px 0 16px">
-        <strong>{total_label}</strong>
+        <strong>${L.total}</strong>
         <strong id="cartTotal">0</strong>
       </div>
 
@@ -3649,116 +5587,91 @@ header{{background:#111;color:#fff;padding:18px 16px;position:sticky;top:0;z-ind
         Click / Payme integration ready structure. Real API can be connected later.
       </div>
 
-      <div class="field">
-        <label>{name_label}</label>
-        <input id="name" />
-      </div>
-      <div class="field">
-        <label>{phone_label}</label>
-        <input id="phone" />
-      </div>
-      <div class="field">
-        <label>{city_label}</label>
-        <input id="city" />
-      </div>
-      <div class="field">
-        <label>{delivery_label_title}</label>
-        <select id="delivery">
-          <option value="yandex_courier">{delivery_1}</option>
-          <option value="b2b_post">{delivery_2}</option>
-          <option value="yandex_pvz">{delivery_3}</option>
-        </select>
-      </div>
-      <div class="field">
-        <label>{payment_label_title}</label>
-        <select id="payment">
+      ${field("name", L.name)}
+      ${field("phone", L.phone)}
+      ${field("city", L.city)}
+      ${field("delivery", L.delivery, `<select id="delivery">
+          <option value="yandex_courier">${L.delivery_1}</option>
+          <option value="b2b_post">${L.delivery_2}</option>
+          <option value="yandex_pvz">${L.delivery_3}</option>
+        </select>`)}
+      ${field("payment", L.payment, `<select id="payment">
           <option value="click">Click</option>
           <option value="payme">Payme</option>
-        </select>
-      </div>
-      <div class="field">
-        <label>{address_label}</label>
-        <input id="address" />
-      </div>
-      <div class="field">
-        <label>{comment_label}</label>
-        <textarea id="comment" rows="3"></textarea>
-      </div>
+        </select>`)}
+      ${field("address", L.address)}
+      ${field("comment", L.comment, `<textarea id="comment" rows="3"></textarea>`)}
 
-      <button class="btn" onclick="submitOrder()">{order_label}</button>
-      <button class="btn secondary" style="margin-top:10px" onclick="clearCart()">{empty_cart_label}</button>
+      <button class="btn" onclick="submitOrder()">${L.order}</button>
+      <button class="btn secondary" style="margin-top:10px" onclick="clearCart()">${L.empty_cart}</button>
     </aside>
   </div>
-</div>
-
-<script>
-const LANG = "{lang}";
-let PRODUCTS = [];
-let CART = JSON.parse(localStorage.getItem("zary_cart") || "[]");
+</div>`;
+}
 
-function money(v) {{
-  try {{
+function money(v) {
+  try {
     return Number(v || 0).toLocaleString("ru-RU");
-  }} catch(e) {{
+  } catch(e) {
     return String(v || 0);
-  }}
-}}
+  }
+}
 
-function saveCart() {{
+function saveCart() {
   localStorage.setItem("zary_cart", JSON.stringify(CART));
-}}
+}
 
-function renderCart() {{
+function renderCart() {
   const box = document.getElementById("cartList");
   const totalEl = document.getElementById("cartTotal");
 
-  if (!CART.length) {{
-    box.innerHTML = '<div class="muted">{empty_cart_label}</div>';
+  if (!CART.length) {
+    box.innerHTML = `<div class="muted">${L.empty_cart}</div>`;
     totalEl.textContent = '0';
     return;
-  }}
+  }
 
   let total = 0;
-  box.innerHTML = CART.map((item, idx) => {{
+  box.innerHTML = CART.map((item, idx) => {
     const line = (Number(item.price || 0) * Number(item.qty || 1));
     total += line;
     return `
       <div class="cart-item">
-        <div><b>${{item.title}}</b></div>
-        <div class="muted">${{item.size || '—'}} | x${{item.qty || 1}}</div>
+        <div><b>${item.title}</b></div>
+        <div class="muted">${item.size || '—'} | x${item.qty || 1}</div>
         <div class="row">
-          <span>${{money(item.price)}} сум</span>
-          <button class="btn secondary" style="width:auto;padding:4px 8px" onclick="removeCartItem(${{idx}})">✕</button>
+          <span>${money(item.price)} сум</span>
+          <button class="btn secondary" style="width:auto;padding:4px 8px" onclick="removeCartItem(${idx})">✕</button>
         </div>
       </div>
     `;
-  }}).join("");
+  }).join("");
 
   totalEl.textContent = money(total) + " сум";
-}}
+}
 
-function removeCartItem(idx) {{
+function removeCartItem(idx) {
   CART.splice(idx, 1);
   saveCart();
   renderCart();
-}}
+}
 
-function clearCart() {{
+function clearCart() {
   CART = [];
   saveCart();
   renderCart();
-}}
+}
 
-function addToCart(productId) {{
+function addToCart(productId) {
   const product = PRODUCTS.find(p => Number(p.id) === Number(productId));
   if (!product) return;
 
   let chosenSize = "";
-  if (product.sizes && product.sizes.length) {{
-    chosenSize = prompt("{sizes_label}: " + product.sizes.join(", "), product.sizes[0]) || product.sizes[0];
-  }}
+  if (product.sizes && product.sizes.length) {
+    chosenSize = prompt(L.sizes + ": " + product.sizes.join(", "), product.sizes[0]) || product.sizes[0];
+  }
 
-  CART.push({{
+  CART.push({
     id: product.id,
     product_id: product.id,
     title: product.title,
@@ -3766,46 +5679,228 @@ function addToCart(productId) {{
     qty: 1,
     price: product.price || 0,
     size: chosenSize
-  }});
+  });
 
   saveCart();
   renderCart();
-}}
+}
 
-function renderProducts() {{
+function renderProducts(items) {
   const box = document.getElementById("products");
-  box.innerHTML = PRODUCTS.map(p => `
+  box.insertAdjacentHTML("beforeend", items.map(p => `
     <div class="card">
-      ${
-        "`${p.photo ? `<img src=\"${p.photo}\" alt=\"\">` : `<div class=\"ph\">No photo</div>`}`"
-      }
+      ${p.photo ? `<img src="${p.photo}" alt="">` : `<div class="ph">No photo</div>`}
       <div class="card-body">
-        <h3>${"${p.title || ''}"}</h3>
-        <div class="muted">${"${p.description || ''}"}</div>
-        <div class="sizes"><b>{sizes_label}:</b> ${"${(p.sizes || []).join(', ') || '—'}"}</div>
-        <div class="stock"><b>{stock_label}:</b> ${"${p.stock_qty || 0}"}</div>
-        ${"${p.old_price ? `<div class=\"old\">{old_price_label}: ${money(p.old_price)} сум</div>` : ''}"}
-        <div class="price">${"${money(p.price || 0)}"} сум</div>
-        <button class="btn" onclick="addToCart(${ "${p.id}" })">{add_to_cart_label}</button>
+        <h3>${p.title || ''}</h3>
+        <div class="muted">${p.description || ''}</div>
+        <div class="sizes"><b>${L.sizes}:</b> ${(p.sizes || []).join(', ') || '—'}</div>
+        <div class="stock"><b>${L.stock}:</b> ${p.stock_qty || 0}</div>
+        ${p.old_price ? `<div class="old">${L.old_price}: ${money(p.old_price)} сум</div>` : ''}
+        <div class="price">${money(p.price || 0)} сум</div>
+        <button class="btn" onclick="addToCart(${p.id})">${L.add_to_cart}</button>
       </div>
     </div>
-  `).join("");
-}}
+  `).join(""));
+}
+
+function catalogUrl(params) {
+  return "/api/shop/products?lang=" + LANG + "&fields=" + FIELDS + params;
+}
+
+function sortProducts() {
+  PRODUCTS.sort((a, b) => (a.sort_order || 0) - (b.sort_order || 0) || b.id - a.id);
+}
+
+function renderAllProducts() {
+  document.getElementById("products").innerHTML = "";
+  renderProducts(PRODUCTS);
+}
+
+async function loadProducts(cursor) {
+  if (LOADING) return;
+  LOADING = true;
+  try {
+    let params = "&limit=" + PAGE_SIZE;
+    if (cursor) params += "&cursor=" + encodeURIComponent(cursor);
+    const res = await fetch(catalogUrl(params));
+    const data = await res.json();
+    // Версия первой страницы: всё, что поменяется дальше, придёт следующей дельтой
+    if (!cursor) CATALOG_VERSION = data.version || 0;
+    const seen = new Set(PRODUCTS.map(p => p.id));
+    const items = (data.products || []).filter(p => !seen.has(p.id));
+    PRODUCTS = PRODUCTS.concat(items);
+    NEXT_CURSOR = data.next_cursor || null;
+    renderProducts(items);
+  } finally {
+    LOADING = false;
+  }
+  if (STORE) {
+    // Для локальной копии нужен весь каталог: остальные страницы грузятся сразу, в фоне
+    if (NEXT_CURSOR) loadProducts(NEXT_CURSOR);
+    else storeSave(PRODUCTS, [], CATALOG_VERSION, true).catch(() => {});
+    return;
+  }
+  watchMore();
+}
+
+function idbRequest(req) {
+  return new Promise((resolve, reject) => {
+    req.onsuccess = () => resolve(req.result);
+    req.onerror = () => reject(req.error);
+  });
+}
+
+async function openStore() {
+  if (!window.indexedDB) return null;
+  try {
+    const req = indexedDB.open("zary_catalog_" + LANG, 1);
+    req.onupgradeneeded = () => {
+      req.result.createObjectStore("products", {keyPath: "id"});
+      req.result.createObjectStore("meta");
+    };
+    return await idbRequest(req);
+  } catch(e) {
+    return null;
+  }
+}
 
-async function loadProducts() {{
-  const res = await fetch("/api/shop/products?lang=" + LANG);
+async function storeLoad() {
+  const tx = STORE.transaction(["products", "meta"]);
+  const [products, version] = await Promise.all([
+    idbRequest(tx.objectStore("products").getAll()),
+    idbRequest(tx.objectStore("meta").get("version")),
+  ]);
+  return {products: products || [], version: version || 0};
+}
+
+function storeSave(upserts, deletedIds, version, replace) {
+  const tx = STORE.transaction(["products", "meta"], "readwrite");
+  const products = tx.objectStore("products");
+  if (replace) products.clear();
+  deletedIds.forEach(id => products.delete(id));
+  upserts.forEach(p => products.put(p));
+  tx.objectStore("meta").put(version, "version");
+  return new Promise((resolve, reject) => {
+    tx.oncomplete = () => resolve();
+    tx.onerror = () => reject(tx.error);
+  });
+}
+
+// Применяет изменения после CATALOG_VERSION; false — копию надо собрать заново
+async function syncCatalog() {
+  const res = await fetch(catalogUrl("&since=" + CATALOG_VERSION));
   const data = await res.json();
-  PRODUCTS = data.products || [];
-  renderProducts();
-}}
+  if (data.status !== "ok" || data.reset) return false;
+
+  const changed = data.products || [];
+  const deleted = data.deleted || [];
+  if (changed.length || deleted.length) {
+    const byId = new Map(PRODUCTS.map(p => [p.id, p]));
+    deleted.forEach(id => byId.delete(id));
+    changed.forEach(p => byId.set(p.id, p));
+    PRODUCTS = Array.from(byId.values());
+    sortProducts();
+    renderAllProducts();
+  }
+  CATALOG_VERSION = data.version;
+  await storeSave(changed, deleted, data.version, false);
+  return true;
+}
+
+// Постоянный покупатель сразу видит сохранённый каталог, с сервера приходит только дельта
+async function initCatalog() {
+  STORE = await openStore();
+  if (STORE) {
+    let local = {products: [], version: 0};
+    try {
+      local = await storeLoad();
+    } catch(e) {
+      console.warn("catalog store unavailable", e);
+    }
+    if (local.version) {
+      PRODUCTS = local.products;
+      CATALOG_VERSION = local.version;
+      sortProducts();
+      renderAllProducts();
+      try {
+        if (await syncCatalog()) return;
+      } catch(e) {
+        // Нет сети — остаётся сохранённая копия, синхронизация при следующем открытии
+        console.warn("catalog sync failed", e);
+        return;
+      }
+    }
+    PRODUCTS = [];
+    document.getElementById("products").innerHTML = "";
+  }
+  loadProducts();
+}
+
+// Следующая страница грузится, когда конец списка подходит к экрану
+function watchMore() {
+  if (!NEXT_CURSOR) return;
+  const sentinel = document.getElementById("more");
+  if (!("IntersectionObserver" in window)) {
+    loadProducts(NEXT_CURSOR);
+    return;
+  }
+  if (!MORE_OBSERVER) {
+    MORE_OBSERVER = new IntersectionObserver(entries => {
+      if (entries.some(e => e.isIntersecting) && NEXT_CURSOR) loadProducts(NEXT_CURSOR);
+    }, {rootMargin: "600px"});
+  }
+  // Повторное observe сразу сообщает текущую видимость, если страница короче экрана
+  MORE_OBSERVER.unobserve(sentinel);
+  MORE_OBSERVER.observe(sentinel);
+}
+
+// Ключ привязан к телу запроса: после правки корзины или контактов нужен новый,
+// иначе сервер ответит 422 (ключ уже использован для другого заказа)
+function orderKey(body) {
+  let saved = null;
+  try {
+    saved = JSON.parse(sessionStorage.getItem("zary_order_key") || "null");
+  } catch(e) {
+    saved = null;
+  }
+  if (saved && saved.key && saved.body === body) return saved.key;
+
+  const key = (window.crypto && crypto.randomUUID)
+    ? crypto.randomUUID()
+    : Date.now().toString(36) + "-" + Math.random().toString(36).slice(2);
+  sessionStorage.setItem("zary_order_key", JSON.stringify({key, body}));
+  return key;
+}
+
+// Один ключ на все попытки: сервер вернёт уже созданный заказ, а не создаст новый
+async function postOrder(payload) {
+  const body = JSON.stringify(payload);
+  const key = orderKey(body);
+  let lastError = null;
+  for (let attempt = 0; attempt < 3; attempt++) {
+    try {
+      const res = await fetch("/api/shop/order", {
+        method: "POST",
+        headers: {"Content-Type": "application/json", "Idempotency-Key": key},
+        body
+      });
+      if (res.status === 422) sessionStorage.removeItem("zary_order_key");
+      return await res.json();
+    } catch(e) {
+      lastError = e;
+      await new Promise(resolve => setTimeout(resolve, 1000 * (attempt + 1)));
+    }
+  }
+  throw lastError;
+}
 
-async function submitOrder() {{
-  if (!CART.length) {{
-    alert("{empty_cart_label}");
+async function submitOrder() {
+  if (!CART.length) {
+    alert(L.empty_cart);
     return;
-  }}
+  }
 
-  const payload = {{
+  const payload = {
     name: document.getElementById("name").value.trim(),
     phone: document.getElementById("phone").value.trim(),
     city: document.getElementById("city").value.trim(),
@@ -3814,40 +5909,153 @@ async function submitOrder() {{
     address: document.getElementById("address").value.trim(),
     comment: document.getElementById("comment").value.trim(),
     items: CART
-  }};
+  };
 
-  if (!payload.name || !payload.phone) {{
+  if (!payload.name || !payload.phone) {
     alert("Fill name and phone");
     return;
-  }}
-
-  const res = await fetch("/api/shop/order", {{
-    method: "POST",
-    headers: {{"Content-Type": "application/json"}},
-    body: JSON.stringify(payload)
-  }});
-
-  const data = await res.json();
-  if (data.status === "ok") {{
-    alert("{success_label} #" + data.order_id);
-    clearCart();
+  }
+
+  if (SUBMITTING) return;
+  SUBMITTING = true;
+  // Снимок корзины: если её успели изменить во время запроса, новые товары не стираем
+  const sentCart = JSON.stringify(CART);
+  let data;
+  try {
+    data = await postOrder(payload);
+  } catch(e) {
+    // Ключ остаётся в sessionStorage: повторное нажатие не создаст второй заказ
+    alert(e.message || "Network error");
+    return;
+  } finally {
+    SUBMITTING = false;
+  }
+
+  if (data.status === "ok") {
+    sessionStorage.removeItem("zary_order_key");
+    alert(L.success + " #" + data.order_id);
+    if (JSON.stringify(CART) === sentCart) clearCart();
     document.getElementById("name").value = "";
     document.getElementById("phone").value = "";
     document.getElementById("city").value = "";
     document.getElementById("address").value = "";
     document.getElementById("comment").value = "";
-  }} else {{
+  } else {
     alert(data.message || "Error");
-  }}
-}}
+  }
+}
 
-loadProducts();
+renderLayout();
+initCatalog();
 renderCart();
-</script>
-</body>
+"""
+
+
+# =========================================================
+# STATIC ASSETS
+# =========================================================
+# Файлы с хешем содержимого в имени: {имя: (content-type, тело, тело в gzip)}
+static_assets: Dict[str, Tuple[str, bytes, bytes]] = {}
+# Логическое имя -> опубликованный URL, например "shop.css" -> "/static/shop.1a2b3c4d5e.css"
+static_urls: Dict[str, str] = {}
+
+
+def static_asset_add(logical_name: str, content_type: str, text: str) -> str:
+    raw = text.encode("utf-8")
+    stem, _, ext = logical_name.rpartition(".")
+    name = f"{stem}.{hashlib.sha1(raw).hexdigest()[:10]}.{ext}"
+    static_assets[name] = (content_type, raw, gzip.compress(raw, compresslevel=9, mtime=0))
+    static_urls[logical_name] = f"/static/{name}"
+    return static_urls[logical_name]
+
+
+def static_assets_build() -> None:
+    """Собирает CSS, JS и подписи витрины; старые хеши остаются доступны для уже открытых страниц."""
+    static_asset_add("shop.css", "text/css", SHOP_CSS)
+    static_asset_add("shop.js", "application/javascript", SHOP_JS)
+    for lang, labels in SHOP_LABELS.items():
+        bundle = dict(labels, follow_tg=FOLLOW_TG, follow_ig=FOLLOW_IG, follow_yt=FOLLOW_YT)
+        static_asset_add(
+            f"labels-{lang}.js",
+            "application/javascript",
+            f"window.SHOP_LABELS = {json.dumps(bundle, ensure_ascii=False)};\n",
+        )
+
+
+async def static_file(request: web.Request) -> web.Response:
+    asset = static_assets.get(request.match_info.get("name", ""))
+    if not asset:
+        return web.Response(text="Not found", status=404)
+    content_type, raw, packed = asset
+
+    # Имя меняется вместе с содержимым, поэтому файл можно кешировать навсегда
+    headers = {"Cache-Control": "public, max-age=31536000, immutable", "Vary": "Accept-Encoding"}
+    use_gzip = accepts_gzip(request)
+    if use_gzip:
+        headers["Content-Encoding"] = "gzip"
+    return web.Response(
+        body=packed if use_gzip else raw,
+        content_type=content_type,
+        charset="utf-8",
+        headers=headers,
+    )
+
+
+# =========================================================
+# WEB PAGES
+# =========================================================
+def render_shop_page(lang: str) -> str:
+    labels = SHOP_LABELS.get(lang) or SHOP_LABELS["ru"]
+    return f"""<!DOCTYPE html>
+<html lang="{lang}">
+<head>
+<meta charset="utf-8"/>
+<meta name="viewport" content="width=device-width, initial-scale=1"/>
+<title>{esc(labels["title"])}</title>
+<link rel="stylesheet" href="{static_urls["shop.css"]}"/>
+<script src="{static_urls[f"labels-{lang}.js"]}" defer></script>
+<script src="{static_urls["shop.js"]}" defer></script>
+</head>
+<body><div id="app"></div></body>
 </html>
 """
-    return web.Response(text=html_page, content_type="text/html")
+
+
+# Страница магазина не зависит от запроса, кроме языка:
+# {lang: (ETag, тело, тело в gzip)}
+shop_page_cache: Dict[str, Tuple[str, bytes, bytes]] = {}
+
+
+def shop_pages_build() -> None:
+    """Рендерит и сжимает страницу для всех языков. Вызывается при старте и после смены подписей."""
+    static_assets_build()
+    for lang in SHOP_LABELS:
+        raw = render_shop_page(lang).encode("utf-8")
+        etag = hashlib.sha1(raw).hexdigest()[:20]
+        shop_page_cache[lang] = (etag, raw, gzip.compress(raw, compresslevel=9, mtime=0))
+
+
+async def shop_index(request: web.Request) -> web.Response:
+    lang = parse_web_lang(request)
+    if lang not in shop_page_cache:
+        shop_pages_build()
+    etag, raw, packed = shop_page_cache[lang]
+
+    use_gzip = accepts_gzip(request)
+    # У сжатого и несжатого варианта разные байты, значит и разные ETag
+    etag = f'"{etag}-gz"' if use_gzip else f'"{etag}"'
+    headers = {"ETag": etag, "Cache-Control": "no-cache", "Vary": "Accept-Encoding"}
+    if etag_matches(request, etag):
+        return web.Response(status=304, headers=headers)
+
+    if use_gzip:
+        headers["Content-Encoding"] = "gzip"
+    return web.Response(
+        body=packed if use_gzip else raw,
+        content_type="text/html",
+        charset="utf-8",
+        headers=headers,
+    )
 
 
 # =========================================================
@@ -3855,7 +6063,7 @@ renderCart();
 # =========================================================
 async def pay_click_page(request: web.Request) -> web.Response:
     order_id = safe_int(request.match_info.get("order_id"))
-    order = db.order_get(order_id)
+    order = await db.order_get(order_id)
 
     if not order:
         return web.Response(text="Order not found", status=404)
@@ -3879,15 +6087,15 @@ async def pay_click_page(request: web.Request) -> web.Response:
 
 async def pay_click_success(request: web.Request) -> web.Response:
     order_id = safe_int(request.match_info.get("order_id"))
-    order = db.order_get(order_id)
+    order = await db.order_get(order_id)
     if not order:
         return web.Response(text="Order not found", status=404)
 
-    db.order_update_payment(order_id, "paid")
-    db.order_update_status(order_id, "paid")
+    await db.order_update_payment(order_id, "paid")
+    await db.order_update_status(order_id, "paid")
 
     if order.get("user_id"):
-        user_lang = get_user_lang(order["user_id"])
+        user_lang = await get_user_lang(order["user_id"])
         try:
             if user_lang == "uz":
                 await bot.send_message(order["user_id"], f"💳 Buyurtmangiz #{order_id} bo'yicha to'lov tasdiqlandi.")
@@ -3901,7 +6109,7 @@ async def pay_click_success(request: web.Request) -> web.Response:
 
 async def pay_payme_page(request: web.Request) -> web.Response:
     order_id = safe_int(request.match_info.get("order_id"))
-    order = db.order_get(order_id)
+    order = await db.order_get(order_id)
 
     if not order:
         return web.Response(text="Order not found", status=404)
@@ -3925,15 +6133,15 @@ async def pay_payme_page(request: web.Request) -> web.Response:
 
 async def pay_payme_success(request: web.Request) -> web.Response:
     order_id = safe_int(request.match_info.get("order_id"))
-    order = db.order_get(order_id)
+    order = await db.order_get(order_id)
     if not order:
         return web.Response(text="Order not found", status=404)
 
-    db.order_update_payment(order_id, "paid")
-    db.order_update_status(order_id, "paid")
+    await db.order_update_payment(order_id, "paid")
+    await db.order_update_status(order_id, "paid")
 
     if order.get("user_id"):
-        user_lang = get_user_lang(order["user_id"])
+        user_lang = await get_user_lang(order["user_id"])
         try:
             if user_lang == "uz":
                 await bot.send_message(order["user_id"], f"💳 Buyurtmangiz #{order_id} bo'yicha to'lov tasdiqlandi.")
@@ -3948,12 +6156,127 @@ async def pay_payme_success(request: web.Request) -> web.Response:
 # =========================================================
 # API
 # =========================================================
-async def api_shop_products(request: web.Request) -> web.Response:
+# Готовый JSON каталога по параметрам запроса: {запрос: (версия каталога, ETag, тело ответа)}
+catalog_cache = LruTtlCache(CATALOG_CACHE_SIZE, 3600)
+
+# (lang, category, after, limit, fields, since)
+CatalogQuery = Tuple[str, str, Optional[Tuple[int, int]], int, Tuple[str, ...], Optional[int]]
+
+
+def parse_catalog_query(request: web.Request) -> CatalogQuery:
+    """
+    Разбирает ?category=&cursor=&limit=&fields=&since= в нормализованный ключ
+    (lang, category, after, limit, fields, since). Ошибка в параметрах — ValueError.
+    """
     lang = parse_web_lang(request)
-    products = db.shop_products_list(published_only=True, limit=500)
 
-    result = [product_to_web_dict(p, lang) for p in products if safe_int(p.get("is_published"), 1) == 1]
-    return web.json_response({"status": "ok", "products": result})
+    category = (request.query.get("category") or "").strip().lower()
+    if category and category not in SHOP_CATEGORIES:
+        raise ValueError("Unknown category")
+
+    after = None
+    cursor = (request.query.get("cursor") or "").strip()
+    if cursor:
+        sort_order, sep, product_id = cursor.partition("_")
+        try:
+            after = (int(sort_order), int(product_id))
+        except ValueError:
+            raise ValueError("Invalid cursor") from None
+        if not sep:
+            raise ValueError("Invalid cursor")
+
+    limit = min(max(safe_int(request.query.get("limit"), CATALOG_PAGE_SIZE), 1), CATALOG_PAGE_MAX)
+
+    fields: Tuple[str, ...] = PRODUCT_WEB_FIELDS
+    requested = [f.strip() for f in (request.query.get("fields") or "").split(",") if f.strip()]
+    if requested:
+        known = product_to_web_dict({}, lang)
+        unknown = [f for f in requested if f not in known]
+        if unknown:
+            raise ValueError("Unknown fields: " + ", ".join(unknown))
+        # id нужен клиенту всегда: по нему корзина и заказ
+        fields = tuple(dict.fromkeys(["id", *requested]))
+
+    since_raw = (request.query.get("since") or "").strip()
+    if since_raw:
+        if not since_raw.isdigit():
+            raise ValueError("Invalid since")
+        # Дельта не листается и не фильтруется: остальные параметры не дробят кеш
+        return lang, "", None, 0, fields, int(since_raw)
+
+    return lang, category, after, limit, fields, None
+
+
+async def catalog_delta(lang: str, fields: Tuple[str, ...], since: int, version: int) -> Dict[str, Any]:
+    """
+    Что поменялось в каталоге после версии since: товары для замены и id для удаления.
+    reset — дельту собрать нельзя, клиент загружает каталог заново.
+    """
+    # Клиент видел версию новее базы (например, база восстановлена из бэкапа)
+    if since > version:
+        return {"status": "ok", "version": version, "reset": True}
+
+    changed, deleted = await db.shop_products_changed(since, CATALOG_DELTA_MAX + 1)
+    if len(changed) > CATALOG_DELTA_MAX or len(deleted) > CATALOG_DELTA_MAX:
+        return {"status": "ok", "version": version, "reset": True}
+
+    products = []
+    for p in changed:
+        if safe_int(p.get("is_published"), 1) == 1:
+            item = product_to_web_dict(p, lang)
+            products.append({f: item[f] for f in fields})
+        else:
+            deleted.append(p["id"])
+    return {"status": "ok", "version": version, "products": products, "deleted": deleted}
+
+
+async def catalog_payload(query: CatalogQuery) -> Tuple[str, bytes]:
+    """
+    Тело /api/shop/products собирается один раз на версию каталога и набор параметров.
+    Версия читается до выборки: если товар поменяют во время сборки,
+    следующий запрос увидит новую версию и пересоберёт кеш.
+    """
+    version = db.sync.catalog_version
+    cached = catalog_cache.get(query)
+    if cached and cached[0] == version:
+        return cached[1], cached[2]
+
+    lang, category, after, limit, fields, since = query
+    if since is not None:
+        payload = await catalog_delta(lang, fields, since, version)
+    else:
+        # Лишняя строка показывает, есть ли следующая страница
+        products = await db.shop_products_page(category, after, limit + 1)
+        next_cursor = None
+        if len(products) > limit:
+            products = products[:limit]
+            last = products[-1]
+            next_cursor = f"{safe_int(last.get('sort_order'))}_{last['id']}"
+
+        result = []
+        for p in products:
+            item = product_to_web_dict(p, lang)
+            result.append({f: item[f] for f in fields})
+        # version — с какой версии клиенту потом запрашивать дельту
+        payload = {"status": "ok", "version": version, "products": result, "next_cursor": next_cursor}
+
+    body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+    etag = f'"{hashlib.sha1(body).hexdigest()[:20]}"'
+    catalog_cache.set(query, (version, etag, body))
+    return etag, body
+
+
+async def api_shop_products(request: web.Request) -> web.Response:
+    try:
+        query = parse_catalog_query(request)
+    except ValueError as e:
+        return web.json_response({"status": "error", "message": str(e)}, status=400)
+    etag, body = await catalog_payload(query)
+
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if etag_matches(request, etag):
+        return web.Response(status=304, headers=headers)
+    return web.Response(body=body, content_type="application/json", charset="utf-8", headers=headers)
 
 
 async def api_shop_order(request: web.Request) -> web.Response:
@@ -3974,6 +6297,10 @@ async def api_shop_order(request: web.Request) -> web.Response:
     if not name or not phone_is_valid(phone):
         return web.json_response({"status": "error", "message": "Invalid name or phone"}, status=400)
 
+    idempotency_key = (request.headers.get("Idempotency-Key") or "").strip()
+    if len(idempotency_key) > 128 or not idempotency_key.isprintable():
+        return web.json_response({"status": "error", "message": "Invalid Idempotency-Key"}, status=400)
+
     if delivery_type not in DELIVERY_TYPES:
         delivery_type = "yandex_courier"
 
@@ -3981,12 +6308,17 @@ async def api_shop_order(request: web.Request) -> web.Response:
         payment_method = "click"
 
     normalized_items: List[Dict[str, Any]] = []
+    # Строки корзины как их прислал клиент: из них и контактов считается хеш запроса
+    request_lines: List[List[Any]] = []
     total_qty = 0
     total_amount = 0
 
-    for item in items:
-        product_id = safe_int(item.get("product_id") or item.get("id"), 0)
-        product = db.shop_product_get(product_id) if product_id else None
+    # Все товары корзины одним запросом, а не по запросу на строку
+    item_ids = [safe_int(item.get("product_id") or item.get("id"), 0) for item in items]
+    products = await db.shop_products_get_many([pid for pid in item_ids if pid])
+
+    for item, product_id in zip(items, item_ids):
+        product = products.get(product_id)
 
         title = (
             (product.get("title_ru") if product else None)
@@ -3997,6 +6329,13 @@ async def api_shop_order(request: web.Request) -> web.Response:
         price = safe_int(product.get("price"), 0) if product else safe_int(item.get("price"), 0)
         qty = max(1, safe_int(item.get("qty"), 1))
         size = (item.get("size") or "").strip()
+        request_lines.append([
+            product_id,
+            qty,
+            size,
+            item.get("product_name") or item.get("title") or "",
+            safe_int(item.get("price"), 0),
+        ])
 
         normalized_items.append({
             "product_id": product_id or None,
@@ -4010,7 +6349,13 @@ async def api_shop_order(request: web.Request) -> web.Response:
         total_qty += qty
         total_amount += price * qty
 
-    order_id = db.order_create({
+    # Цены из базы в хеш не входят: изменение цены между повторами не ломает повтор
+    request_hash = hashlib.sha256(json.dumps(
+        [name, phone, city, address, comment, delivery_type, payment_method, request_lines],
+        ensure_ascii=False,
+    ).encode("utf-8")).hexdigest()
+
+    order, created = await db.order_place({
         "user_id": None,
         "username": "",
         "customer_name": name,
@@ -4027,13 +6372,24 @@ async def api_shop_order(request: web.Request) -> web.Response:
         "comment": comment,
         "status": "new",
         "source": "web",
-    })
+    }, idempotency_key, request_hash)
+
+    if order is None:
+        return web.json_response(
+            {"status": "error", "message": "Idempotency-Key was already used for a different order"},
+            status=422,
+        )
 
-    order = db.order_get(order_id)
-    await send_order_to_admins(order_id)
+    order_id = order["id"]
+    if not created:
+        # Повтор уже принятого запроса: админы и оплата уже уведомлены
+        return web.json_response(
+            {"status": "ok", "order_id": order_id},
+            headers={"Idempotent-Replayed": "true"},
+        )
 
-    if order:
-        await send_payment_stub(order, "ru")
+    await send_order_to_admins(order)
+    await send_payment_stub(order, "ru")
 
     return web.json_response({"status": "ok", "order_id": order_id})
 
@@ -4069,8 +6425,8 @@ async def admin_dashboard(request: web.Request) -> web.Response:
     if not admin_panel_allowed(token):
         return web.Response(text="Access denied", status=403)
 
-    stats = db.get_stats_all()
-    products_count = db.shop_products_count()
+    stats = await db.get_stats_all()
+    products_count = await db.shop_products_count()
 
     html_page = f"""
 <!DOCTYPE html>
@@ -4110,6 +6466,18 @@ a.btn{{display:inline-block;padding:12px 16px;background:#111;color:#fff;text-de
     return web.Response(text=html_page, content_type="text/html")
 
 
+async def admin_db_profile_page(request: web.Request) -> web.Response:
+    token = request.query.get("token", "")
+    if not admin_panel_allowed(token):
+        return web.Response(text="Access denied", status=403)
+
+    if request.query.get("reset") == "1":
+        db_profiler.reset()
+
+    limit = max(1, min(200, safe_int(request.query.get("limit"), 50)))
+    return web.json_response(db_profiler.report(limit=limit), dumps=lambda x: json.dumps(x, ensure_ascii=False))
+
+
 async def admin_orders_page(request: web.Request) -> web.Response:
     token = request.query.get("token", "")
     if not admin_panel_allowed(token):
@@ -4119,7 +6487,28 @@ async def admin_orders_page(request: web.Request) -> web.Response:
     city = (request.query.get("city") or "").strip()
     phone_q = (request.query.get("phone") or "").strip()
 
-    rows = db.orders_filter(status=status, city=city, phone_q=phone_q, limit=300)
+    cursor = (request.query.get("cursor") or "").strip()
+    page_size = min(200, max(1, safe_int(request.query.get("per_page"), 50)))
+
+    page = await db.orders_filter(status=status, city=city, phone_q=phone_q, page_size=page_size, cursor=cursor)
+    rows = page["rows"]
+    items_map = await db.order_items_by_orders([o["id"] for o in rows])
+
+    def page_link(page_cursor: str) -> str:
+        return "/admin/orders?" + urlencode({
+            "token": token,
+            "status": status,
+            "city": city,
+            "phone": phone_q,
+            "per_page": page_size,
+            "cursor": page_cursor,
+        })
+
+    pager = []
+    if page["prev_cursor"]:
+        pager.append(f'<a href="{esc(page_link(page["prev_cursor"]))}">← Новее</a>')
+    if page["next_cursor"]:
+        pager.append(f'<a href="{esc(page_link(page["next_cursor"]))}">Старее →</a>')
 
     html_page = f"""
 <!DOCTYPE html>
@@ -4138,6 +6527,7 @@ input,select{{padding:10px;border:1px solid #ddd;border-radius:8px}}
 button{{padding:10px 14px;border:none;background:#111;color:#fff;border-radius:8px;cursor:pointer}}
 a{{display:inline-block;margin-bottom:20px}}
 .form{{display:flex;gap:10px;flex-wrap:wrap;margin-bottom:16px}}
+.pager{{display:flex;gap:16px;margin-top:16px}}
 </style>
 </head>
 <body>
@@ -4175,8 +6565,9 @@ a{{display:inline-block;margin-bottom:20px}}
 <th>Сумма</th>
 <th>Статус</th>
 </tr>
-{admin_orders_html_rows(rows)}
+{admin_orders_html_rows(rows, items_map)}
 </table>
+<div class="pager">{" ".join(pager)}</div>
 </div>
 </body>
 </html>
@@ -4189,7 +6580,7 @@ async def admin_products_page(request: web.Request) -> web.Response:
     if not admin_panel_allowed(token):
         return web.Response(text="Access denied", status=403)
 
-    rows = db.shop_products_list(published_only=False, limit=500)
+    rows = await db.shop_products_list(published_only=False, limit=500)
 
     html_page = f"""
 <!DOCTYPE html>
@@ -4256,11 +6647,29 @@ async def cron_monthly(request: web.Request) -> web.Response:
     return web.Response(text="monthly ok", status=200)
 
 
+async def cron_backup(request: web.Request) -> web.Response:
+    secret = request.query.get("secret", "")
+    if not cron_allowed(secret):
+        return web.Response(text="Forbidden", status=403)
+
+    if backup_lock.locked():
+        return web.Response(text="backup already running", status=409)
+
+    try:
+        result = await run_backup()
+    except Exception as e:
+        # Недописанные .tmp/.gz backup_create уже удалил
+        print("cron_backup error:", e)
+        return web.json_response({"status": "error", "message": f"backup failed: {e}"}, status=500)
+    return web.Response(text=f"backup ok: {Path(result['path']).name}", status=200)
+
+
 # =========================================================
 # ROUTES
 # =========================================================
 web_app.router.add_get("/", shop_index)
 web_app.router.add_get("/health", health)
+web_app.router.add_get("/static/{name}", static_file)
 
 web_app.router.add_get("/api/shop/products", api_shop_products)
 web_app.router.add_post("/api/shop/order", api_shop_order)
@@ -4275,17 +6684,27 @@ web_app.router.add_post("/pay/payme/{order_id}/success", pay_payme_success)
 web_app.router.add_get("/admin", admin_dashboard)
 web_app.router.add_get("/admin/orders", admin_orders_page)
 web_app.router.add_get("/admin/products", admin_products_page)
+web_app.router.add_get("/admin/db-profile", admin_db_profile_page)
 
 web_app.router.add_get("/cron/daily", cron_daily)
 web_app.router.add_get("/cron/monthly", cron_monthly)
+web_app.router.add_get("/cron/backup", cron_backup)
 
 
 # =========================================================
 # STARTUP
 # =========================================================
 async def on_startup():
+    shop_pages_build()
     print("Starting reminders loop...")
     asyncio.create_task(reminders_loop())
+    asyncio.create_task(events_flush_loop())
+    if EVENTS_RETENTION_DAYS > 0:
+        asyncio.create_task(events_retention_loop())
+    if CART_TTL_DAYS > 0:
+        asyncio.create_task(carts_expire_loop())
+    if BACKUP_INTERVAL_HOURS > 0:
+        asyncio.create_task(backup_loop())
 
 
 async def main():
@@ -4302,7 +6721,11 @@ async def main():
     print(f"Web server started on port {PORT}")
     print("Bot polling started")
 
-    await dp.start_polling(bot)
+    try:
+        await dp.start_polling(bot)
+    finally:
+        await runner.cleanup()
+        db.close()
 
 
 if __name__ == "__main__":